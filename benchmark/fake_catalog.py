@@ -0,0 +1,213 @@
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from botocore.awsrequest import AWSResponse
+
+'''
+In-process stand-in for the AWS Marketplace Catalog API. It answers the HTTP requests of the real
+boto3 client, so the client's parsing, the Lambdas' rate limiter and retry policy all run as they
+do in AWS, only the service is simulated. Latency, throttling and the change set duration are
+configurable to reproduce the conditions of the scenario.
+'''
+
+
+class _RawResponse:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+def _timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeCatalog:
+    page_size = 20
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, change_set_duration=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.change_set_duration = change_set_duration
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._entities = {}
+        self._change_sets = {}
+        self.throttled = 0
+
+    # Entities
+
+    def add_experience(self, experience_id, policy_id, approved=(), rejected=(), status='Enabled'):
+        self._entities[experience_id] = {'EntityType': 'Experience', 'LastModifiedDate': _timestamp(),
+                                         'Details': {'Status': status, 'ProcurementPolicies': [policy_id]}}
+        self._entities[policy_id] = {'EntityType': 'ProcurementPolicy', 'LastModifiedDate': _timestamp(),
+                                     'Experience': experience_id, 'Allow': set(approved), 'Deny': set(rejected)}
+
+    def get_products(self, experience_id):
+        policy = self._entities[self._entities[experience_id]
+                                ['Details']['ProcurementPolicies'][0]]
+        return set(policy['Allow']), set(policy['Deny'])
+
+    def _details(self, entity):
+        if entity['EntityType'] != 'ProcurementPolicy':
+            return entity['Details']
+        return {'Statements': [{'Effect': effect, 'Resources': [{'Type': 'Product', 'Ids': sorted(entity[effect])}]}
+                               for effect in ('Allow', 'Deny') if entity[effect]]}
+
+    # Operations
+
+    def list_entities(self, request):
+        entity_ids = sorted(e for e, entity in self._entities.items()
+                            if entity['EntityType'] == request['EntityType'])
+        start = int(request.get('NextToken', 0))
+        page_size = request.get('MaxResults', self.page_size)
+        response = {'EntitySummaryList': [{'EntityId': e, 'EntityType': self._entities[e]['EntityType'],
+                                           'LastModifiedDate': self._entities[e]['LastModifiedDate']}
+                                          for e in entity_ids[start:start + page_size]]}
+        if start + page_size < len(entity_ids):
+            response['NextToken'] = str(start + page_size)
+        return response
+
+    def describe_entity(self, request):
+        entity_id = request['entityId'][0]
+        if entity_id not in self._entities:
+            raise FakeCatalogError(404, 'ResourceNotFoundException',
+                                   f"Entity {entity_id} not found")
+        entity = self._entities[entity_id]
+        return {'EntityType': entity['EntityType'], 'EntityIdentifier': entity_id,
+                'LastModifiedDate': entity['LastModifiedDate'], 'Details': json.dumps(self._details(entity))}
+
+    def batch_describe_entities(self, request):
+        if len(request['EntityRequestList']) > 20:
+            raise FakeCatalogError(400, 'ValidationException',
+                                   'At most 20 entities can be described at once')
+        details = {}
+        errors = {}
+        for entity_request in request['EntityRequestList']:
+            entity_id = entity_request['EntityId']
+            if entity_id not in self._entities:
+                errors[entity_id] = {'ErrorCode': 'ResourceNotFoundException',
+                                     'ErrorMessage': f"Entity {entity_id} not found"}
+                continue
+            entity = self._entities[entity_id]
+            details[entity_id] = {'EntityType': entity['EntityType'], 'LastModifiedDate': entity['LastModifiedDate'],
+                                  'DetailsDocument': self._details(entity)}
+        return {'EntityDetails': details, 'Errors': errors}
+
+    def start_change_set(self, request):
+        changes = [(c['Entity']['Identifier'], c['ChangeType'])
+                   for c in request['ChangeSet']]
+        if len(changes) > 20:
+            raise FakeCatalogError(400, 'ValidationException',
+                                   'A change set has at most 20 changes')
+        # Like the service, a change type can only be made once on an entity in a change set
+        if len(set(changes)) < len(changes):
+            raise FakeCatalogError(400, 'ValidationException',
+                                   'A change set can only have one change of a type on an entity')
+        experience_ids = {c['Entity']['Identifier']
+                          for c in request['ChangeSet']}
+        # Like the service, a request token already used returns the change set it started
+        for change_set_id, change_set in self._change_sets.items():
+            if request.get('ClientRequestToken') and change_set['ClientRequestToken'] == request['ClientRequestToken']:
+                return {'ChangeSetId': change_set_id, 'ChangeSetArn': f"arn:aws:aws-marketplace:us-east-1::AWSMarketplace/ChangeSet/{change_set_id}"}
+        for change_set in self._change_sets.values():
+            if change_set['Status'] == 'APPLYING' and experience_ids & change_set['Experiences']:
+                raise FakeCatalogError(400, 'ResourceInUseException',
+                                       'The entity is already used by another change set')
+        for experience_id in experience_ids:
+            if experience_id not in self._entities:
+                raise FakeCatalogError(404, 'ResourceNotFoundException',
+                                       f"Entity {experience_id} not found")
+        change_set_id = f"cs-{next(self._ids):08d}"
+        self._change_sets[change_set_id] = {'Status': 'APPLYING', 'StartedAt': time.monotonic(), 'StartTime': _timestamp(),
+                                            'Experiences': experience_ids, 'ChangeSet': request['ChangeSet'],
+                                            'ClientRequestToken': request.get('ClientRequestToken')}
+        return {'ChangeSetId': change_set_id, 'ChangeSetArn': f"arn:aws:aws-marketplace:us-east-1::AWSMarketplace/ChangeSet/{change_set_id}"}
+
+    def describe_change_set(self, request):
+        change_set_id = request['changeSetId'][0]
+        if change_set_id not in self._change_sets:
+            raise FakeCatalogError(404, 'ResourceNotFoundException',
+                                   f"Change set {change_set_id} not found")
+        change_set = self._change_sets[change_set_id]
+        if change_set['Status'] == 'APPLYING' and time.monotonic() - change_set['StartedAt'] >= self.change_set_duration:
+            self._apply(change_set)
+            change_set['Status'] = 'SUCCEEDED'
+        return {'ChangeSetId': change_set_id, 'Status': change_set['Status'], 'StartTime': change_set['StartTime'],
+                'ChangeSet': [{'ChangeType': c['ChangeType'], 'Entity': c['Entity'], 'Details': c['Details']}
+                              for c in change_set['ChangeSet']]}
+
+    def list_change_sets(self, request):
+        for change_set_id in list(self._change_sets):
+            self.describe_change_set({'changeSetId': [change_set_id]})
+        statuses = {v for f in request.get('FilterList', []) if f['Name'] == 'Status' for v in f['ValueList']}
+        change_sets = [{'ChangeSetId': change_set_id, 'Status': c['Status'],
+                        'EntityIdList': sorted(c['Experiences'])} for change_set_id, c in self._change_sets.items()
+                       if not statuses or c['Status'] in statuses]
+        return {'ChangeSetSummaryList': change_sets}
+
+    def _apply(self, change_set):
+        for change in change_set['ChangeSet']:
+            experience = self._entities[change['Entity']['Identifier']]
+            policy = self._entities[experience['Details']
+                                    ['ProcurementPolicies'][0]]
+            product_ids = {i for p in json.loads(
+                change['Details'])['Products'] for i in p['Ids']}
+            if change['ChangeType'] == 'AllowProductProcurement':
+                policy['Allow'] |= product_ids
+                policy['Deny'] -= product_ids
+            else:
+                policy['Deny'] |= product_ids
+                policy['Allow'] -= product_ids
+            policy['LastModifiedDate'] = _timestamp()
+
+    # Transport
+
+    def register(self, events):
+        # Registered first so the request is answered before it reaches any other stub
+        events.register_first(
+            'before-send.marketplace-catalog', self.handle_request)
+
+    def handle_request(self, request, event_name, **kwargs):
+        operation = event_name.split('.')[-1]
+        handler = getattr(self, ''.join(
+            '_' + c.lower() if c.isupper() else c for c in operation).lstrip('_'), None)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self._lock:
+                if self._random.random() < self.throttle_rate:
+                    self.throttled += 1
+                    raise FakeCatalogError(
+                        429, 'ThrottlingException', 'Rate exceeded')
+                if handler is None:
+                    raise FakeCatalogError(400, 'ValidationException',
+                                           f"{operation} isn't simulated")
+                if request.method == 'GET':
+                    body = handler(parse_qs(urlsplit(request.url).query))
+                else:
+                    body = handler(json.loads(request.body or b'{}'))
+            status = 200
+        except FakeCatalogError as e:
+            status = e.status
+            body = {'Message': e.message}
+            headers = {'x-amzn-ErrorType': e.code}
+        else:
+            headers = {}
+        headers['Content-Type'] = 'application/json'
+        return AWSResponse(request.url, status, headers, _RawResponse(json.dumps(body).encode()))
+
+
+class FakeCatalogError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
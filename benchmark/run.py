@@ -0,0 +1,393 @@
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+'''
+Runs the management and member lambda_handler entry points against in-process stand-ins of the
+AWS services: the Marketplace Catalog is simulated by fake_catalog.FakeCatalog, DynamoDB, STS, SSM,
+SNS, SQS and Organizations by moto. Each scenario generates a synthetic organization with N member
+experiences and M products, and reports the wall time, the API calls and the peak memory of each
+Lambda. The results can be saved and compared with a baseline to track regressions.
+'''
+
+os.environ.update({'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'benchmark',
+                   'AWS_SECRET_ACCESS_KEY': 'benchmark', 'AWS_SESSION_TOKEN': 'benchmark'})
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+from moto.core.botocore_stubber import BotocoreStubber  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_catalog import FakeCatalog  # noqa: E402
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+management_experience_id = 'exp-management'
+sync_state_table_name = 'pmp-member-SyncState'
+snapshot_bucket_name = 'pmp-management-snapshots'
+
+# warm: the organization is synced once before the measured run
+# drift: fraction of the management products changed before the measured run
+# fan_out: the member sync is fanned out to workers through the work queue
+scenarios = {
+    'cold': {'experiences': 10, 'products': 500, 'warm': False, 'drift': 0.0},
+    'drift': {'experiences': 10, 'products': 500, 'warm': True, 'drift': 0.05},
+    'steady': {'experiences': 10, 'products': 500, 'warm': True, 'drift': 0.0},
+    'throttled': {'experiences': 10, 'products': 500, 'warm': True, 'drift': 0.05, 'throttle_rate': 0.2},
+    'large': {'experiences': 50, 'products': 5000, 'warm': True, 'drift': 0.05},
+    'fanout': {'experiences': 50, 'products': 500, 'warm': True, 'drift': 0.05, 'fan_out': True},
+}
+
+
+class LambdaContext:
+    def __init__(self, timeout=900):
+        self._deadline = time.monotonic() + timeout
+        self.aws_request_id = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+# Counts the calls made by every boto3 client, including the retried ones
+class ApiCallCounter:
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def register(self, events):
+        events.register('before-call', self.before_call)
+
+    def before_call(self, event_name, **kwargs):
+        self.calls[event_name[len('before-call.'):]] += 1
+
+    def reset(self):
+        calls = dict(self.calls)
+        self.calls.clear()
+        return calls
+
+
+# tracemalloc counts what the stand-ins of the AWS services allocate, moto's tables and responses
+# included, with the Lambdas' own allocations. The memory allocated while a stand-in handles a
+# request is kept out of the peak: it is subtracted from the traced memory, and the peak is reset
+# when the request returns. Requests of other threads overlapping a Lambda's allocations make it
+# an approximation.
+class StandInMemory:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handling = 0
+        self._entered_at = 0
+        self.reset()
+
+    def reset(self):
+        self._allocated = 0
+        self._peak = 0
+
+    def wrap(self, function):
+        def wrapper(*args, **kwargs):
+            self._enter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit()
+        return wrapper
+
+    def _enter(self):
+        if not tracemalloc.is_tracing():
+            return
+        with self._lock:
+            if self._handling == 0:
+                current, peak = tracemalloc.get_traced_memory()
+                self._peak = max(self._peak, peak - self._allocated)
+                self._entered_at = current
+            self._handling += 1
+
+    def _exit(self):
+        if not tracemalloc.is_tracing():
+            return
+        with self._lock:
+            self._handling -= 1
+            if self._handling == 0:
+                self._allocated += tracemalloc.get_traced_memory()[0] - \
+                    self._entered_at
+                tracemalloc.reset_peak()
+
+    # Peak memory of the Lambda since the reset
+    def peak(self):
+        with self._lock:
+            return max(self._peak, tracemalloc.get_traced_memory()[1] - self._allocated)
+
+
+stand_in_memory = StandInMemory()
+BotocoreStubber.__call__ = stand_in_memory.wrap(BotocoreStubber.__call__)
+FakeCatalog.handle_request = stand_in_memory.wrap(FakeCatalog.handle_request)
+
+
+def load_lambda(name, component):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(root, component, 'src', 'lambda', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_table(table_name):
+    boto3.client('dynamodb').create_table(TableName=table_name, KeySchema=[{'AttributeName': 'ID', 'KeyType': 'HASH'}],
+                                          AttributeDefinitions=[{'AttributeName': 'ID', 'AttributeType': 'S'}], BillingMode='PAY_PER_REQUEST')
+
+
+def put_parameters(prefix, parameters):
+    client = boto3.client('ssm')
+    for name, value in parameters.items():
+        client.put_parameter(Name=f"{prefix}{name}",
+                             Value=value, Type='String', Overwrite=True)
+
+
+class Organization:
+    def __init__(self, experiences, products, catalog):
+        self.catalog = catalog
+        self.approved = {f"prod-{i:06d}" for i in range(products * 9 // 10)}
+        self.rejected = {f"prod-{i:06d}" for i in range(
+            products * 9 // 10, products)}
+        self.next_product = products
+        self.experience_ids = [
+            f"exp-member-{i:04d}" for i in range(experiences)]
+
+    def setup(self):
+        self.management_catalog = FakeCatalog(**self.catalog)
+        self.management_catalog.add_experience(
+            management_experience_id, 'procpolicy-management', self.approved, self.rejected)
+        self.member_catalog = FakeCatalog(**self.catalog)
+        for i, experience_id in enumerate(self.experience_ids):
+            self.member_catalog.add_experience(
+                experience_id, f"procpolicy-member-{i:04d}")
+
+        prefix = management_experience_id
+        for table_name in ('ApprovedProducts', 'RejectedProducts', 'SyncTimestamps', 'ListVersions'):
+            create_table(f"{prefix}-{table_name}")
+        create_table(sync_state_table_name)
+        boto3.client('s3').create_bucket(Bucket=snapshot_bucket_name)
+
+        topic_arn = boto3.client('sns').create_topic(
+            Name='pmp-products-updated')['TopicArn']
+        sqs = boto3.client('sqs')
+        self.queue_url = sqs.create_queue(
+            QueueName='pmp-member')['QueueUrl']
+        queue_arn = sqs.get_queue_attributes(QueueUrl=self.queue_url, AttributeNames=['QueueArn'])[
+            'Attributes']['QueueArn']
+        boto3.client('sns').subscribe(TopicArn=topic_arn,
+                                      Protocol='sqs', Endpoint=queue_arn)
+        self.work_queue_url = sqs.create_queue(
+            QueueName='pmp-member-work')['QueueUrl']
+        boto3.client('organizations').create_organization(FeatureSet='ALL')
+
+        put_parameters(f"/{prefix}/", {'experience': management_experience_id, 'ApprovedTable': f"{prefix}-ApprovedProducts",
+                                       'RejectedTable': f"{prefix}-RejectedProducts", 'ListVersionsTable': f"{prefix}-ListVersions",
+                                       'SNSarn': topic_arn, 'SnapshotBucket': snapshot_bucket_name, 'AllwaysSendNotification': 'true'})
+        put_parameters('/pmp/', {'ApprovedTable': f"{prefix}-ApprovedProducts", 'RejectedTable': f"{prefix}-RejectedProducts",
+                                 'SyncTimestampsTableName': f"{prefix}-SyncTimestamps",
+                                 'CrossAccountAccessRoleARN': 'arn:aws:iam::123456789012:role/pmp-member-access'})
+
+    # Moves drift of the management products: half are new approved products, half approved ones now rejected
+    def apply_drift(self, drift):
+        changes = int((len(self.approved) + len(self.rejected)) * drift)
+        added = {f"prod-{i:06d}" for i in range(
+            self.next_product, self.next_product + changes // 2)}
+        self.next_product += len(added)
+        moved = set(sorted(self.approved)[:changes - len(added)])
+        self.approved = (self.approved - moved) | added
+        self.rejected |= moved
+        self.management_catalog.add_experience(
+            management_experience_id, 'procpolicy-management', self.approved, self.rejected)
+
+    def receive_notifications(self, queue_url=None):
+        queue_url = queue_url or self.queue_url
+        response = boto3.client('sqs').receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10)
+        messages = response.get('Messages', [])
+        for message in messages:
+            boto3.client('sqs').delete_message(
+                QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        return {'Records': [{'messageId': m['MessageId'], 'body': m['Body']} for m in messages]}
+
+    def is_converged(self):
+        return all(self.member_catalog.get_products(e) == (self.approved, self.rejected) for e in self.experience_ids)
+
+
+def measure(counter, handler, event):
+    counter.reset()
+    stand_in_memory.reset()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    error = None
+    try:
+        # The Lambdas print their metrics to stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler(event, LambdaContext())
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall_time = time.perf_counter() - started_at
+    peak_memory = stand_in_memory.peak()
+    tracemalloc.stop()
+    calls = counter.reset()
+    return {'WallTime': round(wall_time, 3), 'ApiCalls': sum(calls.values()), 'Operations': calls,
+            'PeakMemory': peak_memory, 'Error': error}
+
+
+def run_scenario(name, experiences, products, warm, drift, throttle_rate=0.0, latency=0.0,
+                 change_set_duration=0.0, min_poll_interval=0.05, fan_out=False):
+    catalog = {'latency': latency, 'throttle_rate': throttle_rate,
+               'change_set_duration': change_set_duration}
+    organization = Organization(experiences, products, catalog)
+    os.environ['SSM_PREFIX'] = management_experience_id
+    os.environ['SYNC_STATE_TABLE'] = sync_state_table_name
+    with mock_aws():
+        boto3.setup_default_session()
+        counter = ApiCallCounter()
+        counter.register(boto3.DEFAULT_SESSION.events)
+        organization.setup()
+        if fan_out:
+            os.environ['WORK_QUEUE_URL'] = organization.work_queue_url
+        else:
+            os.environ.pop('WORK_QUEUE_URL', None)
+        management = load_lambda('management_app', 'management')
+        member = load_lambda('member_app', 'member')
+        # The simulated change sets take change_set_duration, not minutes
+        member.ChangeSetPipeline.min_poll_interval = min_poll_interval
+        member.ChangeSetPipeline.initial_expected_duration = change_set_duration
+
+        def run(phase_catalog, handler, event):
+            phase_catalog.register(boto3.DEFAULT_SESSION.events)
+            try:
+                return measure(counter, handler, event)
+            finally:
+                boto3.DEFAULT_SESSION.events.unregister(
+                    'before-send.marketplace-catalog', phase_catalog.handle_request)
+
+        # The orchestrator, then the workers one work item at a time until the work queue is empty
+        def member_handler(event, context):
+            result = member.lambda_handler(event, context)
+            work_items = organization.receive_notifications(
+                organization.work_queue_url)
+            while len(work_items['Records']):
+                for record in work_items['Records']:
+                    member.worker_handler({'Records': [record]}, context)
+                work_items = organization.receive_notifications(
+                    organization.work_queue_url)
+            return result
+
+        if warm:
+            throttle_rates = (organization.management_catalog.throttle_rate,
+                              organization.member_catalog.throttle_rate)
+            organization.management_catalog.throttle_rate = organization.member_catalog.throttle_rate = 0
+            run(organization.management_catalog,
+                management.lambda_handler, {})
+            run(organization.member_catalog, member_handler,
+                organization.receive_notifications())
+            organization.management_catalog.throttle_rate, organization.member_catalog.throttle_rate = throttle_rates
+        if drift:
+            organization.apply_drift(drift)
+
+        result = {'Management': run(organization.management_catalog, management.lambda_handler, {})}
+        result['Member'] = run(organization.member_catalog,
+                               member_handler, organization.receive_notifications())
+        result['Throttled'] = organization.management_catalog.throttled + \
+            organization.member_catalog.throttled
+        result['Converged'] = organization.is_converged()
+        return result
+
+
+def print_results(results):
+    print(f"{'scenario':<12}{'lambda':<12}{'wall (s)':>10}{'API calls':>11}{'peak (MiB)':>12}  top operations")
+    for name, result in results.items():
+        for phase in ('Management', 'Member'):
+            r = result[phase]
+            top = ', '.join(f"{op} {n}" for op, n in sorted(
+                r['Operations'].items(), key=lambda i: -i[1])[:4])
+            print(f"{name:<12}{phase:<12}{r['WallTime']:>10.3f}{r['ApiCalls']:>11}{r['PeakMemory'] / 2**20:>12.1f}  {top}")
+            if r['Error']:
+                print(f"{'':<24}error: {r['Error']}")
+        print(f"{'':<24}throttled: {result['Throttled']}, converged: {result['Converged']}")
+
+
+# Increases below these are measurement noise, whatever the tolerance
+min_increase = {'WallTime': 1.0, 'ApiCalls': 0, 'PeakMemory': 2**20}
+
+
+# Regressions are the metrics more than tolerance above the baseline, and the scenarios that stopped converging
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if baseline[name]['Converged'] and not result['Converged']:
+            regressions.append(f"{name}: the experiences didn't converge")
+        for phase in ('Management', 'Member'):
+            for metric in ('WallTime', 'ApiCalls', 'PeakMemory'):
+                before = baseline[name][phase][metric]
+                after = result[phase][metric]
+                if after > before * (1 + tolerance) and after - before > min_increase[metric]:
+                    regressions.append(
+                        f"{name} {phase} {metric}: {before} -> {after} (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the management and member Lambdas against simulated AWS services')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run, all by default: {', '.join(scenarios)}")
+    parser.add_argument('--experiences', type=int,
+                        help='member experiences, overrides the scenarios')
+    parser.add_argument('--products', type=int,
+                        help='management products, overrides the scenarios')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every Catalog API call')
+    parser.add_argument('--throttle-rate', type=float,
+                        help='fraction of the Catalog API calls throttled, overrides the scenarios')
+    parser.add_argument('--change-set-duration', type=float, default=0.2,
+                        help='seconds a change set takes to apply')
+    parser.add_argument('--min-poll-interval', type=float, default=0.05,
+                        help='minimum seconds between change set polls')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='increase over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(scenarios)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in args.scenarios or list(scenarios):
+        scenario = dict(scenarios[name])
+        for option in ('experiences', 'products', 'throttle_rate'):
+            if getattr(args, option) is not None:
+                scenario[option] = getattr(args, option)
+        results[name] = run_scenario(name, latency=args.latency, change_set_duration=args.change_set_duration,
+                                     min_poll_interval=args.min_poll_interval, **scenario)
+        results[name]['Scenario'] = scenario
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,697 @@
+import time
+# Start of the module import, for the startup timing mode
+startup_started_at = time.perf_counter()
+import datetime
 import json
 import os
+import sys
+import random
+import hashlib
+import gzip
 import boto3
 import logging
+import threading
+import cProfile
+import marshal
+import pstats
+import tracemalloc
+import zlib
 import jmespath
+from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from botocore.exceptions import ReadTimeoutError
+startup_timings = {'ImportTime': time.perf_counter() - startup_started_at}
 
 experience_id = ''
 ssm_parameter_prefix = "/" + os.getenv("SSM_PREFIX") + "/"
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
-dynamodb = boto3.resource('dynamodb')
+scan_segments = int(os.getenv('SCAN_SEGMENTS', '4'))
+# Attempts per AWS call and seconds before the Lambda timeout at which the run stops
+retry_max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+deadline_margin = int(os.getenv('DEADLINE_MARGIN', '10'))
+invocation_deadline = None
+# Deltas up to max_inline_delta_size bytes travel in the notification, larger ones are stored
+# compressed in the list versions table in chunks members read by reference
+max_inline_delta_size = int(os.getenv('MAX_INLINE_DELTA_SIZE', '200000'))
+delta_chunk_size = 350000
+delta_retention = int(os.getenv('DELTA_RETENTION', '604800'))
+# Runs are skipped while the policy is unchanged, but the tables are reconciled at least every
+# policy_recheck_interval seconds
+policy_recheck_interval = int(os.getenv('POLICY_RECHECK_INTERVAL', '86400'))
+snapshot_key = 'lists.json.gz'
+# Threads writing batches to the tables
+write_concurrency = int(os.getenv('WRITE_CONCURRENCY', '8'))
+# Parameters under ssm_parameter_prefix are loaded in bulk and reused for ssm_cache_ttl seconds
+ssm_cache_ttl = int(os.getenv('SSM_CACHE_TTL', '300'))
+ssm_parameters = {}
+ssm_parameters_loaded_at = None
+ssm_parameters_lock = threading.Lock()
+metrics_namespace = os.getenv('METRICS_NAMESPACE', 'PMPCrossOrg')
+# Members not synced for sync_stale_after seconds are reported as stale
+sync_stale_after = int(os.getenv('SYNC_STALE_AFTER', '7200'))
+# Runs are profiled when PROFILING or the Profiling parameter is true, the profiles are saved to
+# PROFILE_BUCKET if set
+profiling = os.getenv('PROFILING', 'false').lower() in ('yes', 'true', '1')
+profile_top = int(os.getenv('PROFILE_TOP', '20'))
+profile_bucket = os.getenv('PROFILE_BUCKET', '')
+# Reports the import and initialization time of the module in the first invocation's metrics
+startup_timing = os.getenv('STARTUP_TIMING', 'false').lower() in (
+    'yes', 'true', '1')
+# AWS clients are thread safe, they are created once and reused by warm invocations
+clients = {}
+clients_lock = threading.Lock()
+# Product ids of the Allow and Deny statements of a procurement policy
+policy_product_ids_expressions = {effect: jmespath.compile(
+    f"Statements[?Effect=='{effect}'].Resources[].Ids[]") for effect in ('Allow', 'Deny')}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def set_invocation_deadline(context):
+    global invocation_deadline
+    invocation_deadline = None
+    if context is not None:
+        invocation_deadline = time.monotonic() + \
+            context.get_remaining_time_in_millis() / 1000
+
+
+# Seconds left in the current invocation, infinite when it runs outside Lambda
+def remaining_time():
+    if invocation_deadline is None:
+        return float('inf')
+    return invocation_deadline - time.monotonic()
+
+
+# Calls, latency percentiles, retries, throttles and errors of every AWS API call, and the time
+# spent in each phase of the run, printed once per invocation in CloudWatch Embedded Metric Format.
+# Phases can be nested or run in several threads, their times add up the time of every thread.
+class RunMetrics:
+    def __init__(self, component):
+        self._component = component
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operations = {}
+        self._phases = {}
+        self._startup = {}
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('request-created', self._request_created)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _stats(self, event_name):
+        # The operation of before-call.dynamodb.Scan is dynamodb.Scan
+        operation = event_name.split('.', 1)[1]
+        return self._operations.setdefault(operation, {'Calls': 0, 'Retries': 0, 'Throttles': 0, 'Errors': 0, 'Latencies': []})
+
+    # Set by retry_policy while it calls an operation again
+    def set_attempt(self, attempt):
+        self._local.attempt = attempt
+
+    def _before_call(self, event_name, **kwargs):
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Calls'] += 1
+            if getattr(self._local, 'attempt', 0):
+                stats['Retries'] += 1
+
+    # The latency starts once the rate limiter let the call through
+    def _request_created(self, request, **kwargs):
+        request.context.setdefault('metrics_started_at', time.monotonic())
+
+    def _after_call(self, event_name, http_response, parsed, context, **kwargs):
+        latency = time.monotonic() - context.get('metrics_started_at', time.monotonic())
+        code = parsed.get('Error', {}).get('Code', '')
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Latencies'].append(latency)
+            stats['Retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if code in RetryPolicy.throttling_errors or http_response.status_code == 429:
+                stats['Throttles'] += 1
+            elif http_response.status_code >= 400:
+                stats['Errors'] += 1
+
+    def _after_call_error(self, event_name, context, **kwargs):
+        latency = time.monotonic() - context.get('metrics_started_at', time.monotonic())
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Latencies'].append(latency)
+            stats['Errors'] += 1
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(
+                    name, 0) + time.monotonic() - started_at
+
+    def record_startup(self, timings):
+        with self._lock:
+            self._startup = dict(timings)
+
+    def _document(self, dimensions, values, units, timestamp):
+        return {'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{'Namespace': metrics_namespace, 'Dimensions': [list(dimensions)],
+                                                                         'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]}]},
+                **dimensions, **values}
+
+    # Prints the metrics of the invocation and starts over, one document per operation and one for the run
+    def flush(self, context=None):
+        with self._lock:
+            operations, self._operations = self._operations, {}
+            phases, self._phases = self._phases, {}
+            startup, self._startup = self._startup, {}
+        invoked_function_arn = getattr(context, 'invoked_function_arn', '')
+        dimensions = {'Component': self._component,
+                      'AccountId': invoked_function_arn.split(':')[4] if invoked_function_arn.count(':') >= 4 else 'local'}
+        timestamp = int(time.time() * 1000)
+        counters = ('Calls', 'Retries', 'Throttles', 'Errors')
+        for operation, stats in sorted(operations.items()):
+            latencies = sorted(stats['Latencies']) or [0]
+            values = {name: stats[name] for name in counters}
+            for percentile in (50, 90, 99):
+                values[f"LatencyP{percentile}"] = round(latencies[min(
+                    len(latencies) - 1, len(latencies) * percentile // 100)] * 1000, 1)
+            units = {**{name: 'Count' for name in counters},
+                     **{f"LatencyP{p}": 'Milliseconds' for p in (50, 90, 99)}}
+            print(json.dumps(self._document(
+                {**dimensions, 'Operation': operation}, values, units, timestamp)))
+        values = {name: sum(stats[name] for stats in operations.values())
+                  for name in counters}
+        values.update({f"{name}Time": round(seconds, 3)
+                      for name, seconds in phases.items()})
+        units = {**{name: 'Count' for name in counters},
+                 **{f"{name}Time": 'Seconds' for name in phases}}
+        values.update({name: round(seconds * 1000, 1)
+                      for name, seconds in startup.items()})
+        units.update({name: 'Milliseconds' for name in startup})
+        print(json.dumps(self._document(
+            dimensions, values, units, timestamp)))
+
+
+metrics = RunMetrics('Management')
+# Clients are created from the default session, they inherit its handlers
+metrics.register(boto3._get_default_session().events)
+
+
+# Exponential backoff with full jitter. Throttling and transient errors are retried, conflicts
+# are retried with a longer base delay and any other error is raised straight away. It gives up
+# before the invocation gets within deadline_margin seconds of its timeout.
+class RetryPolicy:
+    throttling_errors = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                         'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestThrottled'}
+    conflict_errors = {'ResourceInUseException',
+                       'ConflictException', 'TransactionConflictException'}
+    transient_errors = {'InternalServerException', 'InternalServerError', 'InternalFailure',
+                        'ServiceUnavailable', 'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException'}
+
+    def __init__(self, max_attempts=None, base_delay=1, conflict_delay=5, max_delay=20):
+        self._max_attempts = max_attempts or retry_max_attempts
+        self._base_delay = base_delay
+        self._conflict_delay = conflict_delay
+        self._max_delay = max_delay
+
+    @classmethod
+    def classify(cls, error):
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code', '')
+            if code in cls.throttling_errors:
+                return 'throttling'
+            if code in cls.conflict_errors:
+                return 'conflict'
+            if code in cls.transient_errors or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+                return 'transient'
+            return 'permanent'
+        if isinstance(error, (BotocoreConnectionError, ReadTimeoutError)):
+            return 'transient'
+        return 'permanent'
+
+    def delay(self, error_class, attempt):
+        base_delay = self._conflict_delay if error_class == 'conflict' else self._base_delay
+        return random.uniform(0, min(self._max_delay, base_delay * 2 ** attempt))
+
+    def call(self, operation, *args, **kwargs):
+        name = getattr(operation, '__name__', str(operation))
+        attempt = 0
+        while True:
+            if remaining_time() < deadline_margin:
+                raise DeadlineExceeded(
+                    f"Not enough time left to call {name}")
+            try:
+                metrics.set_attempt(attempt)
+                return operation(*args, **kwargs)
+            except Exception as e:
+                error_class = self.classify(e)
+                attempt += 1
+                if error_class == 'permanent' or attempt >= self._max_attempts:
+                    raise
+                wait_time = self.delay(error_class, attempt)
+                if remaining_time() - wait_time < deadline_margin:
+                    raise DeadlineExceeded(
+                        f"Not enough time left to retry {name}") from e
+                logger.warning(
+                    f"{name} failed with a {error_class} error, retrying in {wait_time:.1f} secs [{attempt}/{self._max_attempts}]: {e}")
+                time.sleep(wait_time)
+            finally:
+                metrics.set_attempt(0)
+
+
+retry_policy = RetryPolicy()
+# Clients whose calls go through retry_policy, so botocore doesn't retry them as well
+no_retries = Config(retries={'max_attempts': 0})
+dynamodb = boto3.resource('dynamodb', config=no_retries)
+
+
+# Client of the service from the pool, created on first use
+def get_client(service_name, region_name=None, config=None):
+    key = (service_name, region_name, id(config))
+    with clients_lock:
+        if key not in clients:
+            with metrics.phase('ClientInit'):
+                clients[key] = boto3.client(
+                    service_name, region_name=region_name, config=config)
+        return clients[key]
+
+
+# Opt-in profiling of a run: cProfile, in the invoking thread and the threads it starts, and
+# tracemalloc. The summary, top functions by cumulative time, top allocation sites and peak
+# memory, is logged as one JSON line. The raw profile, in pstats format, is passed to the sink,
+# any callable taking the profile name and data.
+class RunProfiler:
+    def __init__(self, component, top=None, sink=None):
+        self._component = component
+        self._top = top or profile_top
+        self._sink = sink
+        self._lock = threading.Lock()
+        self._thread_profilers = []
+
+    # threading profile hook, replaced in each new thread by the thread's own profiler
+    def _profile_thread(self, frame, event, arg):
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append(profiler)
+        profiler.enable()
+
+    @contextmanager
+    def profile(self, context=None):
+        self._thread_profilers = []
+        profiler = cProfile.Profile()
+        # Memory may already be traced, by a benchmark for instance
+        trace_memory = not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        threading.setprofile(self._profile_thread)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            threading.setprofile(None)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            allocations = tracemalloc.take_snapshot().statistics('lineno')
+            if trace_memory:
+                tracemalloc.stop()
+            with self._lock:
+                profilers, self._thread_profilers = self._thread_profilers, []
+            self._report(pstats.Stats(profiler, *profilers),
+                         allocations, peak_memory, context)
+
+    def _report(self, stats, allocations, peak_memory, context):
+        functions = sorted(stats.stats.items(),
+                           key=lambda s: s[1][3], reverse=True)[:self._top]
+        logger.info(json.dumps({'Profile': {
+            'Component': self._component,
+            'PeakMemoryKiB': round(peak_memory / 1024),
+            'TopFunctions': [{'Function': f"{file}:{line}({name})", 'Calls': calls, 'CumulativeTime': round(cumulative, 4),
+                              'TotalTime': round(total, 4)} for (file, line, name), (_, calls, total, cumulative, _) in functions],
+            'TopAllocations': [{'Line': f"{a.traceback[0].filename}:{a.traceback[0].lineno}", 'SizeKiB': round(a.size / 1024, 1),
+                                'Count': a.count} for a in allocations[:self._top]]}}))
+        if self._sink is None:
+            return
+        name = f"{self._component}/{datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')}-{getattr(context, 'aws_request_id', 'local')}.prof"
+        try:
+            self._sink(name, marshal.dumps(stats.stats))
+        except Exception:
+            logger.exception(f"Error saving the profile {name}")
+
+
+# Profile sink writing the profiles to S3, under prefix
+class S3ProfileSink:
+    def __init__(self, bucket, prefix='profiles/'):
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def __call__(self, name, data):
+        retry_policy.call(get_client('s3', config=no_retries).put_object,
+                          Bucket=self._bucket, Key=self._prefix + name, Body=data)
+        logger.info(f"Profile saved to s3://{self._bucket}/{self._prefix}{name}")
+
+
+profiler = RunProfiler('Management', sink=S3ProfileSink(
+    profile_bucket) if profile_bucket else None)
+
+
+# Calls the function with args, profiled if profiling is on
+def run_profiled(context, function, *args):
+    if not (profiling or get_ssm_parameter_flag('Profiling')):
+        return function(*args)
+    with profiler.profile(context):
+        return function(*args)
+
+
+# Puts and deletes ids in the tables with BatchWriteItem. The ids of every table are split in
+# batches of 25 shared out to a thread pool, the unprocessed items of a batch are sent again with
+# backoff until they are written or the attempts run out. Only the lists of ids are kept until
+# the flush, the requests of a batch are built when it is written.
+class BulkWriter:
+    batch_size = 25
+
+    def __init__(self, concurrency=None):
+        self._concurrency = concurrency or write_concurrency
+        self._ids = {}
+
+    def put(self, table_name, ids):
+        self._ids.setdefault((table_name, 'put'), []).append(ids)
+        return self
+
+    def delete(self, table_name, ids):
+        self._ids.setdefault((table_name, 'delete'), []).append(ids)
+        return self
+
+    def _write_batch(self, table_name, operation, ids, start):
+        # The resource's low level client is thread safe and still takes python types
+        client = dynamodb.meta.client
+        if operation == 'put':
+            requests = [{'PutRequest': {'Item': {'ID': id}}}
+                        for id in ids[start:start + self.batch_size]]
+        else:
+            requests = [{'DeleteRequest': {'Key': {'ID': id}}}
+                        for id in ids[start:start + self.batch_size]]
+        attempt = 0
+        while True:
+            response = retry_policy.call(
+                client.batch_write_item, RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not requests:
+                return
+            attempt += 1
+            if attempt >= retry_max_attempts:
+                raise RuntimeError(
+                    f"[{len(requests)}] items still unprocessed in table {table_name} after {attempt} attempts")
+            wait_time = retry_policy.delay('throttling', attempt)
+            if remaining_time() - wait_time < deadline_margin:
+                raise DeadlineExceeded(
+                    f"Not enough time left to write the unprocessed items in table {table_name}")
+            logger.info(
+                f"[{len(requests)}] unprocessed items in table {table_name}, retrying in {wait_time:.1f} secs")
+            time.sleep(wait_time)
+
+    # Writes the queued ids of all the tables concurrently and returns the items written per table
+    def flush(self):
+        queued, self._ids = self._ids, {}
+        batches = [(table_name, operation, ids, i) for (table_name, operation), id_lists in queued.items()
+                   for ids in id_lists for i in range(0, len(ids), self.batch_size)]
+        if not batches:
+            return {}
+        started_at = time.monotonic()
+        with metrics.phase('TableWrites'), ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = [executor.submit(self._write_batch, *batch)
+                       for batch in batches]
+            for future in futures:
+                future.result()
+        elapsed = max(time.monotonic() - started_at, 0.001)
+        written = {}
+        for (table_name, operation), id_lists in queued.items():
+            written[table_name] = written.get(
+                table_name, 0) + sum(len(ids) for ids in id_lists)
+        for table_name, count in written.items():
+            logger.info(f"[{count}] items written in table {table_name}")
+        logger.info(
+            f"[{sum(written.values())}] items written in [{len(batches)}] batches in {elapsed:.2f} secs, {sum(written.values()) / elapsed:.0f} items/sec")
+        return written
 
 
 def add_product_id_from_db(ids, table_name):
-    logger.debug(f"Adding product(s) [len({ids})] to {table_name} table")
-    table = dynamodb.Table(table_name)
-    try:
-        with table.batch_writer() as writer:
-            for id in ids:
-                logger.debug(f"Adding product [{id}] to {table_name} table")
-                writer.put_item(Item={'ID': id})
-        logger.info("All Ids added into table %s.", table.name)
-    except ClientError:
-        logger.exception("Error adding Ids into table %s.", table.name)
-        raise
+    logger.debug(f"Adding product(s) [{len(ids)}] to {table_name} table")
+    BulkWriter().put(table_name, ids).flush()
 
 
 def delete_product_id_from_db(ids, table_name):
     logger.debug(f"Deleting product(s) [{len(ids)}] from {table_name} table")
-    table = dynamodb.Table(table_name)
-    try:
-        with table.batch_writer() as writer:
-            for id in ids:
-                logger.debug(
-                    f"Deleting product [{id}] from {table_name} table")
-                writer.delete_item(Key={'ID': id})
-        logger.info("All Ids deleted from table %s.", table.name)
-    except ClientError:
-        logger.exception("Error deleting Ids from table %s.", table.name)
-        raise
+    BulkWriter().delete(table_name, ids).flush()
+
+
+# Yields each id of a sorted iterable once
+def unique_sorted(ids):
+    previous = None
+    for id in ids:
+        if id != previous:
+            yield id
+            previous = id
+
+
+# Single pass over two sorted iterables of ids, without materializing them as sets. Yields
+# ('added', id) for the ids only in new_ids and ('removed', id) for the ids only in old_ids.
+def diff_sorted_ids(new_ids, old_ids):
+    new_ids = unique_sorted(new_ids)
+    old_ids = unique_sorted(old_ids)
+    new = next(new_ids, None)
+    old = next(old_ids, None)
+    while new is not None or old is not None:
+        if old is None or (new is not None and new < old):
+            yield 'added', new
+            new = next(new_ids, None)
+        elif new is None or old < new:
+            yield 'removed', old
+            old = next(old_ids, None)
+        else:
+            new = next(new_ids, None)
+            old = next(old_ids, None)
+
+
+# Sorted ids of the policy statements with the effect, interned so the copies of an id share one string
+def get_policy_product_ids(details, effect):
+    product_ids = [sys.intern(id) for id in policy_product_ids_expressions[effect].search(
+        details) or []]
+    product_ids.sort()
+    return product_ids
+
+
+def scan_segment_ids(table, segment=None, total_segments=1):
+    # The table's low level client is thread safe, the resource is not
+    client = table.meta.client
+    parameters = {'TableName': table.name, 'ProjectionExpression': '#id',
+                  'ExpressionAttributeNames': {'#id': 'ID'}}
+    if total_segments > 1:
+        parameters['Segment'] = segment
+        parameters['TotalSegments'] = total_segments
+    ids = []
+    while True:
+        response = retry_policy.call(client.scan, **parameters)
+        ids.extend(sys.intern(i['ID'])
+                   for i in response['Items'] if 'ID' in i)
+        if 'LastEvaluatedKey' not in response:
+            return ids
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Reads all the IDs in the table following pagination, split in parallel segments if total_segments > 1
+def scan_table_ids(table, total_segments=None):
+    total_segments = total_segments or scan_segments
+    if total_segments <= 1:
+        ids = scan_segment_ids(table)
+    else:
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(lambda segment: scan_segment_ids(
+                table, segment, total_segments), range(total_segments))
+            ids = [id for segment_ids in segments for id in segment_ids]
+    ids.sort()
+    return ids
 
 
 def get_product_ids_from_db(table_name):
     logger.info(f"Getting product_ids from {table_name} table")
-    client = boto3.resource('dynamodb')
-    table = client.Table(table_name)
-    response = table.scan()
-    ids = []
-    for i in response['Items']:
-        ids.append(i.get('ID'))
-        ids.sort()
+    table = dynamodb.Table(table_name)
+    with metrics.phase('TableReads'):
+        ids = scan_table_ids(table)
+    logger.info(f"Fetched [{len(ids)}] ids from {table_name} table")
     return ids
 
 
-def send_update_notification():
+# The list version increases every time the approved or rejected lists change
+def increment_list_version(table_name):
+    table = dynamodb.Table(table_name)
+    response = retry_policy.call(
+        table.update_item,
+        Key={'ID': 'version'},
+        UpdateExpression='ADD Version :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW')
+    return int(response['Attributes']['Version'])
+
+
+def get_list_version(table_name):
+    table = dynamodb.Table(table_name)
+    item = retry_policy.call(table.get_item, Key={
+                             'ID': 'version'}, ConsistentRead=True).get('Item')
+    return int(item['Version']) if item else 0
+
+
+def store_delta(table_name, version, delta):
+    table = dynamodb.Table(table_name)
+    data = zlib.compress(json.dumps(delta).encode())
+    chunks = [data[i:i + delta_chunk_size]
+              for i in range(0, len(data), delta_chunk_size)]
+    expires_at = int(time.time()) + delta_retention
+    # The chunks are close to the item size limit, they are put one by one
+    for i, chunk in enumerate(chunks):
+        retry_policy.call(table.put_item, Item={'ID': f"delta#{version}#{i}",
+                                                'Chunk': chunk, 'ExpiresAt': expires_at})
+    logger.info(
+        f"Delta of version {version} stored in [{len(chunks)}] chunks in {table_name} table")
+    return len(chunks)
+
+
+def get_policy_metadata(table_name):
+    table = dynamodb.Table(table_name)
+    return retry_policy.call(table.get_item, Key={'ID': 'policy'}, ConsistentRead=True).get('Item')
+
+
+def save_policy_metadata(table_name, last_modified, digest):
+    table = dynamodb.Table(table_name)
+    retry_policy.call(table.put_item, Item={'ID': 'policy',
+                                            'LastModified': last_modified,
+                                            'Digest': digest,
+                                            'CheckedAt': str(time.time())})
+
+
+def is_policy_unchanged(metadata, last_modified, digest):
+    return (metadata is not None
+            and metadata.get('LastModified') == last_modified
+            and metadata.get('Digest') == digest
+            and time.time() - float(metadata.get('CheckedAt', 0)) < policy_recheck_interval)
+
+
+# Digest of both lists, it doesn't depend on the order of the ids
+def lists_digest(approved_product_ids, rejected_product_ids):
+    digest = hashlib.sha256()
+    for ids in (approved_product_ids, rejected_product_ids):
+        digest.update('\n'.join(sorted(ids)).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_snapshot_version(bucket):
+    client = get_client('s3', config=no_retries)
+    try:
+        response = retry_policy.call(
+            client.head_object, Bucket=bucket, Key=snapshot_key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return int(response['Metadata'].get('list-version', 0))
+
+
+# Both lists, sorted, with their version and checksum in a single gzip object, so the members
+# fetch them with one conditional GET instead of scanning the tables. The tables remain the
+# source of truth, the snapshot is published again whenever its version falls behind.
+def publish_snapshot(bucket, version, approved_product_ids, rejected_product_ids):
+    snapshot = {'Version': version,
+                'Approved': sorted(approved_product_ids),
+                'Rejected': sorted(rejected_product_ids),
+                'Checksum': lists_digest(approved_product_ids, rejected_product_ids)}
+    if get_snapshot_version(bucket) != version:
+        logger.info(f"Publishing the lists snapshot version {version}")
+        client = get_client('s3', config=no_retries)
+        with metrics.phase('Snapshot'):
+            retry_policy.call(client.put_object, Bucket=bucket, Key=snapshot_key,
+                              Body=gzip.compress(json.dumps(
+                                  snapshot, separators=(',', ':')).encode()),
+                              ContentType='application/gzip',
+                              Metadata={'list-version': str(version), 'checksum': snapshot['Checksum']})
+    return {'Bucket': bucket, 'Key': snapshot_key, 'Version': version}
+
+
+# The notification carries the list version and, when the lists changed, the added and removed ids
+def send_update_notification(version=None, delta=None, list_versions_table_name=None, snapshot=None):
     logger.info("Sending SNS notification")
     message = {"Action": "Products-Updated"}
-    client = boto3.client('sns')
+    if version is not None:
+        message['Version'] = version
+    if snapshot is not None:
+        message['Snapshot'] = snapshot
+    if delta is not None:
+        if len(json.dumps(delta)) <= max_inline_delta_size:
+            message['Delta'] = delta
+        else:
+            message['DeltaRef'] = {'Table': list_versions_table_name,
+                                   'Chunks': store_delta(list_versions_table_name, version, delta)}
+    client = get_client('sns')
     sns_arn = get_ssm_parameter('SNSarn')
-    response = client.publish(TargetArn=sns_arn, Message=json.dumps(message))
+    with metrics.phase('Notification'):
+        response = client.publish(
+            TargetArn=sns_arn, Message=json.dumps(message))
     return response
 
 
-def get_ssm_parameter(param):
-    client = boto3.client('ssm')
-    response = client.get_parameter(Name=ssm_parameter_prefix + param)
+def load_ssm_parameters(force=False):
+    global ssm_parameters, ssm_parameters_loaded_at
+    with ssm_parameters_lock:
+        if not force and ssm_parameters_loaded_at is not None and time.time() - ssm_parameters_loaded_at < ssm_cache_ttl:
+            return ssm_parameters
+
+        client = get_client('ssm')
+        paginator = client.get_paginator('get_parameters_by_path')
+        parameters = {}
+        for page in paginator.paginate(Path=ssm_parameter_prefix.rstrip('/'), Recursive=False, WithDecryption=True):
+            for parameter in page['Parameters']:
+                parameters[parameter['Name'][len(ssm_parameter_prefix):]] = parameter['Value']
+        logger.debug(f"Parameters loaded from parameter store: {list(parameters)}")
+        ssm_parameters = parameters
+        ssm_parameters_loaded_at = time.time()
+        return ssm_parameters
+
+
+def get_ssm_parameter(param, default=None):
+    value = load_ssm_parameters().get(param, default)
+    if value is None:
+        raise KeyError(
+            f"Parameter {ssm_parameter_prefix + param} wasn't found in Parameter store")
     logger.debug('Parameter name ')
     logger.debug(param)
     logger.debug('Parameter value ')
-    logger.debug(response['Parameter']['Value'])
-    return response['Parameter']['Value']
+    logger.debug(value)
+    return value
+
+
+def get_ssm_parameter_flag(param, default=False):
+    value = get_ssm_parameter(param, '')
+    if value == '':
+        return default
+    return value.lower() in ('yes', 'true', '1')
 
 
 class PMP:
     def __init__(self, experience_id):
-        self._client = boto3.client(
-            'marketplace-catalog', region_name='us-east-1')
+        self._client = get_client(
+            'marketplace-catalog', region_name='us-east-1', config=no_retries)
         self._approved_product_ids = []
         self._rejected_product_ids = []
+        self._products_cached = False
+        self._policy_last_modified = None
         self._experience_id = experience_id
 
     def get_proc_policy(self):
@@ -89,73 +703,228 @@ class PMP:
     def get_experience(self):
         parameters = {'Catalog': 'AWSMarketplace',
                       'EntityId': self._experience_id}
-        experience = self._client.describe_entity(**parameters)
+        experience = retry_policy.call(self._client.describe_entity, **parameters)
         return (experience)
 
     def _get_products_in_experience(self):
+        with metrics.phase('CatalogReads'):
+            parameters = {'Catalog': 'AWSMarketplace',
+                          'EntityId': self.get_proc_policy()}
+            experience_description = retry_policy.call(self._client.describe_entity, **parameters)
+            self._policy_last_modified = experience_description.get(
+                'LastModifiedDate', '')
+            details = json.loads(experience_description['Details'])
 
-        parameters = {'Catalog': 'AWSMarketplace',
-                      'EntityId': self.get_proc_policy()}
-        experience_description = self._client.describe_entity(**parameters)
-        details = json.loads(experience_description['Details'])
-
-        if jmespath.search("Statements[?Effect=='Allow'].Resources[].Ids[]", details) != None:
-            self._approved_product_ids = jmespath.search(
-                "Statements[?Effect=='Allow'].Resources[].Ids[]", details)
-        if jmespath.search("Statements[?Effect=='Deny'].Resources[].Ids[]", details) != None:
-            self._rejected_product_ids = jmespath.search(
-                "Statements[?Effect=='Deny'].Resources[].Ids[]", details)
+            self._approved_product_ids = get_policy_product_ids(
+                details, 'Allow')
+            self._rejected_product_ids = get_policy_product_ids(
+                details, 'Deny')
+            self._products_cached = True
 
     def get_approved_products_ids(self):
-        if len(self._approved_product_ids):
+        if self._products_cached:
             return self._approved_product_ids
         self._get_products_in_experience()
         return self._approved_product_ids
 
     def get_rejected_products_ids(self):
-        if len(self._rejected_product_ids):
+        if self._products_cached:
             return self._rejected_product_ids
         self._get_products_in_experience()
         return self._rejected_product_ids
 
+    # Last modified date of the procurement policy and digest of its approved and rejected ids
+    def get_policy_fingerprint(self):
+        if not self._products_cached:
+            self._get_products_in_experience()
+        return self._policy_last_modified, lists_digest(self._approved_product_ids, self._rejected_product_ids)
+
 
 def lambda_handler(event, context):
+    global startup_timings
+    set_invocation_deadline(context)
+    if startup_timings is not None:
+        if startup_timing:
+            logger.info(
+                f"Module imported in {startup_timings['ImportTime'] * 1000:.0f} ms and initialized in {startup_timings['InitTime'] * 1000:.0f} ms")
+            metrics.record_startup(startup_timings)
+        startup_timings = None
+    try:
+        return run_profiled(context, reconcile, event, context)
+    finally:
+        metrics.flush(context)
+
+
+def reconcile(event, context):
     is_updated = False
     logger.info(f"Getting experience_id")
     experience_id = get_ssm_parameter('experience')
-    allways_send_notification = (get_ssm_parameter(
-        'AllwaysSendNotification') == "Yes")
+    allways_send_notification = get_ssm_parameter_flag(
+        'AllwaysSendNotification')
     logger.info(f"Experience Id : [{experience_id}]")
+    table_names = {"approved": get_ssm_parameter('ApprovedTable'),
+                   "rejected": get_ssm_parameter('RejectedTable')}
+    list_versions_table_name = get_ssm_parameter('ListVersionsTable', '')
+    # The snapshot is versioned with the lists, it needs the list versions table
+    snapshot_bucket = get_ssm_parameter(
+        'SnapshotBucket', '') if list_versions_table_name else ''
+    delta = {'Approved': {'Added': [], 'Removed': []},
+             'Rejected': {'Added': [], 'Removed': []}}
 
     pmp = PMP(experience_id)
 
+    if list_versions_table_name:
+        last_modified, digest = pmp.get_policy_fingerprint()
+        if is_policy_unchanged(get_policy_metadata(list_versions_table_name), last_modified, digest):
+            logger.info(
+                f"Procurement policy unchanged since {last_modified}, skipping the tables reconciliation")
+            version = get_list_version(list_versions_table_name)
+            snapshot = publish_snapshot(snapshot_bucket, version, pmp.get_approved_products_ids(
+            ), pmp.get_rejected_products_ids()) if snapshot_bucket else None
+            if allways_send_notification:
+                send_update_notification(version, snapshot=snapshot)
+            return
+
+    # The writes of both tables are sent together once both are compared
+    writer = BulkWriter()
     for i in ["approved", "rejected"]:
         logger.info(f"Working {i} products")
-        table_name = get_ssm_parameter(
-            'ApprovedTable') if i == "approved" else get_ssm_parameter('RejectedTable')
+        table_name = table_names[i]
         logger.debug(f"Table name: {table_name}")
-        table_set = set(get_product_ids_from_db(table_name))
-        logger.info(f"Products in db: {len (table_set)}")
-        pmp_set = set(pmp.get_approved_products_ids() if i ==
-                      "approved" else pmp.get_rejected_products_ids())
-        logger.info(f"Products in experience: {len (pmp_set)}")
-        if (table_set != pmp_set):
+        table_ids = get_product_ids_from_db(table_name)
+        logger.info(f"Products in db: {len (table_ids)}")
+        pmp_ids = pmp.get_approved_products_ids() if i == "approved" else pmp.get_rejected_products_ids()
+        logger.info(f"Products in experience: {len (pmp_ids)}")
+        # Both lists are sorted, they are compared in a single pass
+        product_ids_to_be_added = []
+        product_ids_to_be_deleted = []
+        with metrics.phase('Diffing'):
+            for change, product_id in diff_sorted_ids(pmp_ids, table_ids):
+                (product_ids_to_be_added if change ==
+                 'added' else product_ids_to_be_deleted).append(product_id)
+        del table_ids
+        if product_ids_to_be_added or product_ids_to_be_deleted:
             logger.info(f"Products in db and experience are different")
             is_updated = True
-            product_ids_to_be_added = list(pmp_set - table_set)
             logger.info(
                 f"Number of products to be added: {len(product_ids_to_be_added)}")
             logger.debug(f"Products to be added: {product_ids_to_be_added}")
-            product_ids_to_be_deleted = list(table_set - pmp_set)
             logger.info(
                 f"Number of products to be deleted: {len(product_ids_to_be_deleted)}")
             logger.debug(
                 f"Products to be deleted: {product_ids_to_be_deleted}")
-            logger.info(f"Updating db...")
-            if len(product_ids_to_be_added) > 0:
-                add_product_id_from_db(product_ids_to_be_added, table_name)
-            if len(product_ids_to_be_deleted) > 0:
-                delete_product_id_from_db(
-                    product_ids_to_be_deleted, table_name)
-    if is_updated or allways_send_notification:
-        send_update_notification()
+            # The delta and the writer share the lists of ids, they aren't copied
+            delta[i.capitalize()] = {'Added': product_ids_to_be_added,
+                                     'Removed': product_ids_to_be_deleted}
+            writer.put(table_name, product_ids_to_be_added)
+            writer.delete(table_name, product_ids_to_be_deleted)
+    if is_updated:
+        logger.info(f"Updating db...")
+        writer.flush()
+    if not list_versions_table_name:
+        if is_updated or allways_send_notification:
+            send_update_notification()
+    else:
+        if is_updated:
+            version = increment_list_version(list_versions_table_name)
+            logger.info(f"Lists updated to version {version}")
+        else:
+            version = get_list_version(list_versions_table_name)
+        snapshot = publish_snapshot(snapshot_bucket, version, pmp.get_approved_products_ids(
+        ), pmp.get_rejected_products_ids()) if snapshot_bucket else None
+        if is_updated:
+            send_update_notification(
+                version, delta, list_versions_table_name, snapshot)
+        elif allways_send_notification:
+            # Without a delta the members run a full reconciliation
+            send_update_notification(version, snapshot=snapshot)
+
+    if list_versions_table_name:
+        save_policy_metadata(list_versions_table_name, last_modified, digest)
+
+
+# Items of the BySyncedAt index of the sync timestamps table, oldest sync first. The members write
+# sync_index and synced_at with their sync timestamp, so the index holds every member org.
+def query_member_syncs(table, synced_before=None):
+    key_condition = Key('sync_index').eq('members')
+    if synced_before is not None:
+        key_condition = key_condition & Key('synced_at').lt(int(synced_before))
+    parameters = {'IndexName': 'BySyncedAt',
+                  'KeyConditionExpression': key_condition}
+    items = []
+    while True:
+        response = retry_policy.call(table.query, **parameters)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not len(values):
+        return {}
+    return {f"P{p}": values[min(len(values) - 1, len(values) * p // 100)] for p in (50, 90, 99)} | {'Max': values[-1]}
+
+
+def member_sync_summary(item, now, current_version=None):
+    summary = {'AccountId': item['ID'],
+               'MemberOrgEmail': item.get('member_org_email', ''),
+               'SyncedAt': datetime.datetime.fromtimestamp(int(item['synced_at']), datetime.timezone.utc).isoformat(),
+               'AgeSeconds': int(now - int(item['synced_at']))}
+    if 'list_version' in item:
+        summary['ListVersion'] = int(item['list_version'])
+        if current_version is not None:
+            summary['VersionLag'] = current_version - int(item['list_version'])
+    if 'run_duration' in item:
+        summary['RunDuration'] = int(item['run_duration'])
+    return summary
+
+
+def report_handler(event, context):
+    set_invocation_deadline(context)
+    try:
+        return report_sync_lag(event or {})
+    finally:
+        metrics.flush(context)
+
+
+# Stale members, percentiles of the sync age, list version lag and run duration, and the slowest
+# syncs of the member orgs, queried from the time-ordered index of the sync timestamps table.
+# With StaleOnly in the event only the stale members are read.
+def report_sync_lag(event):
+    stale_after = int(event.get('StaleAfter', sync_stale_after))
+    top = int(event.get('Top', 10))
+    table = dynamodb.Table(get_ssm_parameter('SyncTimestampsTable'))
+    list_versions_table_name = get_ssm_parameter('ListVersionsTable', '')
+    current_version = get_list_version(
+        list_versions_table_name) if list_versions_table_name else None
+    now = time.time()
+
+    if event.get('StaleOnly'):
+        with metrics.phase('TableReads'):
+            stale = query_member_syncs(table, synced_before=now - stale_after)
+        logger.info(
+            f"[{len(stale)}] member orgs not synced for {stale_after} secs")
+        return {'ListVersion': current_version,
+                'Stale': [member_sync_summary(item, now, current_version) for item in stale]}
+
+    with metrics.phase('TableReads'):
+        syncs = query_member_syncs(table)
+    syncs = [member_sync_summary(item, now, current_version) for item in syncs]
+    report = {
+        'Members': len(syncs),
+        'ListVersion': current_version,
+        # Oldest first, the stale members are the first ones
+        'Stale': [s for s in syncs if s['AgeSeconds'] > stale_after],
+        'AgeSeconds': percentiles([s['AgeSeconds'] for s in syncs]),
+        'VersionLag': percentiles([s['VersionLag'] for s in syncs if 'VersionLag' in s]),
+        'RunDuration': percentiles([s['RunDuration'] for s in syncs if 'RunDuration' in s]),
+        'Slowest': sorted([s for s in syncs if 'RunDuration' in s], key=lambda s: -s['RunDuration'])[:top]}
+    logger.info(
+        f"[{len(report['Stale'])}/{report['Members']}] member orgs not synced for {stale_after} secs, sync age {report['AgeSeconds']}, version lag {report['VersionLag']}")
+    return report
+
+
+startup_timings['InitTime'] = time.perf_counter() - \
+    startup_started_at - startup_timings['ImportTime']
@@ -1,14 +1,31 @@
+import time
+# Start of the module import, for the startup timing mode
+startup_started_at = time.perf_counter()
 import json
 import os
+import sys
 import boto3
 import logging
 import uuid
 import jmespath
-import time
 import datetime
-from botocore.exceptions import WaiterError
-from botocore.waiter import WaiterModel
-from botocore.waiter import create_waiter_with_client
+import random
+import hashlib
+import gzip
+import threading
+import cProfile
+import marshal
+import pstats
+import tracemalloc
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from botocore.exceptions import ReadTimeoutError
+startup_timings = {'ImportTime': time.perf_counter() - startup_started_at}
 
 '''
 This function reads the updated approved products in the master Organization private Marketplace DynamoDB tables and compares it
@@ -23,113 +40,1634 @@ my_session = boto3.session.Session()
 my_region = my_session.region_name
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+scan_segments = int(os.getenv('SCAN_SEGMENTS', '4'))
+# Attempts per AWS call and seconds before the Lambda timeout at which the sync stops
+retry_max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+deadline_margin = int(os.getenv('DEADLINE_MARGIN', '20'))
+invocation_deadline = None
+# Local table with the sync checkpoint, a checkpoint older than checkpoint_max_age seconds starts a new sync
+sync_state_table_name = os.getenv('SYNC_STATE_TABLE', '')
+checkpoint_max_age = int(os.getenv('CHECKPOINT_MAX_AGE', '3600'))
+checkpoint_chunk_size = 350000
+# The audience index is reused by warm invocations for audience_index_ttl seconds
+audience_index_ttl = int(os.getenv('AUDIENCE_INDEX_TTL', '900'))
+audience_index = None
+# Seconds before the assumed role credentials expire at which they get refreshed
+credentials_refresh_margin = int(os.getenv('CREDENTIALS_REFRESH_MARGIN', '120'))
+# The cross account DynamoDB resource and S3 client survive warm invocations until their credentials are about to expire
+remote_dynamodb = None
+remote_s3 = None
+remote_credentials_expiration = None
+remote_clients_lock = threading.Lock()
+# Last lists snapshot read, revalidated with its ETag
+snapshot_cache = {}
+# Parameters under ssm_parameter_prefix are loaded in bulk and reused for ssm_cache_ttl seconds
+ssm_cache_ttl = int(os.getenv('SSM_CACHE_TTL', '300'))
+ssm_parameters = {}
+ssm_parameters_loaded_at = None
+ssm_parameters_lock = threading.Lock()
+# Number of experiences synced in parallel and Marketplace Catalog API calls per second shared by all of them
+sync_concurrency = int(os.getenv('SYNC_CONCURRENCY', '4'))
+catalog_api_rate = float(os.getenv('CATALOG_API_RATE', '5'))
+catalog_api_burst = int(os.getenv('CATALOG_API_BURST', '10'))
+# Change sets in flight across all experiences, one at most per experience
+max_change_sets_in_flight = int(os.getenv('MAX_CHANGE_SETS_IN_FLIGHT', '10'))
+# Products per Allow/Deny change, adjusted between the bounds from the change set results,
+# and changes per change set (StartChangeSet accepts up to 20). A change set has one Allow and
+# one Deny change per experience at most, it combines the changes of several experiences.
+change_batch_size = int(os.getenv('CHANGE_BATCH_SIZE', '50'))
+min_change_batch_size = int(os.getenv('MIN_CHANGE_BATCH_SIZE', '10'))
+max_change_batch_size = int(os.getenv('MAX_CHANGE_BATCH_SIZE', '100'))
+max_changes_per_change_set = int(
+    os.getenv('MAX_CHANGES_PER_CHANGE_SET', '20'))
+metrics_namespace = os.getenv('METRICS_NAMESPACE', 'PMPCrossOrg')
+# One sync runs at a time per account. The notifications received meanwhile are folded into one
+# follow-up run, started by the running sync if it has follow_up_min_time seconds left.
+# lease_duration is the lease of the syncs that run outside Lambda.
+follow_up_min_time = int(os.getenv('FOLLOW_UP_MIN_TIME', '300'))
+lease_duration = int(os.getenv('LEASE_DURATION', '900'))
+# Syncs of at least fan_out_min_experiences experiences to update are fanned out to the workers
+# through the work queue, one work item per experience. The fanned out sync holds the lease for
+# fan_out_timeout seconds at most.
+work_queue_url = os.getenv('WORK_QUEUE_URL', '')
+fan_out_min_experiences = int(os.getenv('FAN_OUT_MIN_EXPERIENCES', '20'))
+fan_out_timeout = int(os.getenv('FAN_OUT_TIMEOUT', '3600'))
+fan_out_chunk_size = 350000
+# Lists of the last fanned out sync read by the container, its work items share them
+fan_out_lists_cache = {}
+# Runs are profiled when PROFILING or the Profiling parameter is true, the profiles are saved to
+# PROFILE_BUCKET if set
+profiling = os.getenv('PROFILING', 'false').lower() in ('yes', 'true', '1')
+profile_top = int(os.getenv('PROFILE_TOP', '20'))
+profile_bucket = os.getenv('PROFILE_BUCKET', '')
+# Reports the import and initialization time of the module in the first invocation's metrics
+startup_timing = os.getenv('STARTUP_TIMING', 'false').lower() in (
+    'yes', 'true', '1')
+# AWS clients are thread safe, they are created once and reused by warm invocations
+clients = {}
+clients_lock = threading.Lock()
+management_account_info = None
+# Product ids of the Allow and Deny statements of a procurement policy
+policy_product_ids_expressions = {effect: jmespath.compile(
+    f"Statements[?Effect=='{effect}'].Resources[].Ids[]") for effect in ('Allow', 'Deny')}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def set_invocation_deadline(context):
+    global invocation_deadline
+    invocation_deadline = None
+    if context is not None:
+        invocation_deadline = time.monotonic() + \
+            context.get_remaining_time_in_millis() / 1000
+
+
+# Seconds left in the current invocation, infinite when it runs outside Lambda
+def remaining_time():
+    if invocation_deadline is None:
+        return float('inf')
+    return invocation_deadline - time.monotonic()
+
+
+# Calls, latency percentiles, retries, throttles and errors of every AWS API call, and the time
+# spent in each phase of the run, printed once per invocation in CloudWatch Embedded Metric Format.
+# Phases can be nested or run in several threads, their times add up the time of every thread.
+class RunMetrics:
+    def __init__(self, component):
+        self._component = component
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operations = {}
+        self._phases = {}
+        self._startup = {}
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('request-created', self._request_created)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _stats(self, event_name):
+        # The operation of before-call.dynamodb.Scan is dynamodb.Scan
+        operation = event_name.split('.', 1)[1]
+        return self._operations.setdefault(operation, {'Calls': 0, 'Retries': 0, 'Throttles': 0, 'Errors': 0, 'Latencies': []})
+
+    # Set by retry_policy while it calls an operation again
+    def set_attempt(self, attempt):
+        self._local.attempt = attempt
+
+    def _before_call(self, event_name, **kwargs):
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Calls'] += 1
+            if getattr(self._local, 'attempt', 0):
+                stats['Retries'] += 1
+
+    # The latency starts once the rate limiter let the call through
+    def _request_created(self, request, **kwargs):
+        request.context.setdefault('metrics_started_at', time.monotonic())
+
+    def _after_call(self, event_name, http_response, parsed, context, **kwargs):
+        latency = time.monotonic() - context.get('metrics_started_at', time.monotonic())
+        code = parsed.get('Error', {}).get('Code', '')
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Latencies'].append(latency)
+            stats['Retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if code in RetryPolicy.throttling_errors or http_response.status_code == 429:
+                stats['Throttles'] += 1
+            elif http_response.status_code >= 400:
+                stats['Errors'] += 1
+
+    def _after_call_error(self, event_name, context, **kwargs):
+        latency = time.monotonic() - context.get('metrics_started_at', time.monotonic())
+        with self._lock:
+            stats = self._stats(event_name)
+            stats['Latencies'].append(latency)
+            stats['Errors'] += 1
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(
+                    name, 0) + time.monotonic() - started_at
+
+    def record_startup(self, timings):
+        with self._lock:
+            self._startup = dict(timings)
+
+    def _document(self, dimensions, values, units, timestamp):
+        return {'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{'Namespace': metrics_namespace, 'Dimensions': [list(dimensions)],
+                                                                         'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]}]},
+                **dimensions, **values}
+
+    # Prints the metrics of the invocation and starts over, one document per operation and one for the run
+    def flush(self, context=None):
+        with self._lock:
+            operations, self._operations = self._operations, {}
+            phases, self._phases = self._phases, {}
+            startup, self._startup = self._startup, {}
+        invoked_function_arn = getattr(context, 'invoked_function_arn', '')
+        dimensions = {'Component': self._component,
+                      'AccountId': invoked_function_arn.split(':')[4] if invoked_function_arn.count(':') >= 4 else 'local'}
+        timestamp = int(time.time() * 1000)
+        counters = ('Calls', 'Retries', 'Throttles', 'Errors')
+        for operation, stats in sorted(operations.items()):
+            latencies = sorted(stats['Latencies']) or [0]
+            values = {name: stats[name] for name in counters}
+            for percentile in (50, 90, 99):
+                values[f"LatencyP{percentile}"] = round(latencies[min(
+                    len(latencies) - 1, len(latencies) * percentile // 100)] * 1000, 1)
+            units = {**{name: 'Count' for name in counters},
+                     **{f"LatencyP{p}": 'Milliseconds' for p in (50, 90, 99)}}
+            print(json.dumps(self._document(
+                {**dimensions, 'Operation': operation}, values, units, timestamp)))
+        values = {name: sum(stats[name] for stats in operations.values())
+                  for name in counters}
+        values.update({f"{name}Time": round(seconds, 3)
+                      for name, seconds in phases.items()})
+        units = {**{name: 'Count' for name in counters},
+                 **{f"{name}Time": 'Seconds' for name in phases}}
+        values.update({name: round(seconds * 1000, 1)
+                      for name, seconds in startup.items()})
+        units.update({name: 'Milliseconds' for name in startup})
+        print(json.dumps(self._document(
+            dimensions, values, units, timestamp)))
+
+
+metrics = RunMetrics('Member')
+# Clients are created from the default session, they inherit its handlers
+metrics.register(boto3._get_default_session().events)
+
+
+# Exponential backoff with full jitter. Throttling and transient errors are retried, conflicts
+# are retried with a longer base delay and any other error is raised straight away. It gives up
+# before the invocation gets within deadline_margin seconds of its timeout.
+class RetryPolicy:
+    throttling_errors = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                         'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestThrottled'}
+    conflict_errors = {'ResourceInUseException',
+                       'ConflictException', 'TransactionConflictException'}
+    transient_errors = {'InternalServerException', 'InternalServerError', 'InternalFailure',
+                        'ServiceUnavailable', 'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException'}
+
+    def __init__(self, max_attempts=None, base_delay=1, conflict_delay=5, max_delay=20):
+        self._max_attempts = max_attempts or retry_max_attempts
+        self._base_delay = base_delay
+        self._conflict_delay = conflict_delay
+        self._max_delay = max_delay
+
+    @classmethod
+    def classify(cls, error):
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code', '')
+            if code in cls.throttling_errors:
+                return 'throttling'
+            if code in cls.conflict_errors:
+                return 'conflict'
+            if code in cls.transient_errors or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+                return 'transient'
+            return 'permanent'
+        if isinstance(error, (BotocoreConnectionError, ReadTimeoutError)):
+            return 'transient'
+        return 'permanent'
+
+    def delay(self, error_class, attempt):
+        base_delay = self._conflict_delay if error_class == 'conflict' else self._base_delay
+        return random.uniform(0, min(self._max_delay, base_delay * 2 ** attempt))
+
+    def call(self, operation, *args, **kwargs):
+        name = getattr(operation, '__name__', str(operation))
+        attempt = 0
+        while True:
+            if remaining_time() < deadline_margin:
+                raise DeadlineExceeded(
+                    f"Not enough time left to call {name}")
+            try:
+                metrics.set_attempt(attempt)
+                return operation(*args, **kwargs)
+            except Exception as e:
+                error_class = self.classify(e)
+                attempt += 1
+                if error_class == 'permanent' or attempt >= self._max_attempts:
+                    raise
+                wait_time = self.delay(error_class, attempt)
+                if remaining_time() - wait_time < deadline_margin:
+                    raise DeadlineExceeded(
+                        f"Not enough time left to retry {name}") from e
+                logger.warning(
+                    f"{name} failed with a {error_class} error, retrying in {wait_time:.1f} secs [{attempt}/{self._max_attempts}]: {e}")
+                time.sleep(wait_time)
+            finally:
+                metrics.set_attempt(0)
+
+
+retry_policy = RetryPolicy()
+# Clients whose calls go through retry_policy, so botocore doesn't retry them as well
+no_retries = Config(retries={'max_attempts': 0})
+
+
+# Client of the service from the pool, created on first use. setup is called once with the new client.
+def get_client(service_name, region_name=None, config=None, setup=None):
+    key = (service_name, region_name, id(config))
+    with clients_lock:
+        if key not in clients:
+            with metrics.phase('ClientInit'):
+                client = boto3.client(
+                    service_name, region_name=region_name, config=config)
+                if setup is not None:
+                    setup(client)
+            clients[key] = client
+        return clients[key]
+
+
+# Local DynamoDB table through the pooled client's resource
+def get_local_table(table_name):
+    with clients_lock:
+        if 'dynamodb-resource' not in clients:
+            with metrics.phase('ClientInit'):
+                clients['dynamodb-resource'] = boto3.resource(
+                    'dynamodb', config=no_retries)
+        return clients['dynamodb-resource'].Table(table_name)
+
+
+# Opt-in profiling of a run: cProfile, in the invoking thread and the threads it starts, and
+# tracemalloc. The summary, top functions by cumulative time, top allocation sites and peak
+# memory, is logged as one JSON line. The raw profile, in pstats format, is passed to the sink,
+# any callable taking the profile name and data.
+class RunProfiler:
+    def __init__(self, component, top=None, sink=None):
+        self._component = component
+        self._top = top or profile_top
+        self._sink = sink
+        self._lock = threading.Lock()
+        self._thread_profilers = []
+
+    # threading profile hook, replaced in each new thread by the thread's own profiler
+    def _profile_thread(self, frame, event, arg):
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append(profiler)
+        profiler.enable()
+
+    @contextmanager
+    def profile(self, context=None):
+        self._thread_profilers = []
+        profiler = cProfile.Profile()
+        # Memory may already be traced, by a benchmark for instance
+        trace_memory = not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        threading.setprofile(self._profile_thread)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            threading.setprofile(None)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            allocations = tracemalloc.take_snapshot().statistics('lineno')
+            if trace_memory:
+                tracemalloc.stop()
+            with self._lock:
+                profilers, self._thread_profilers = self._thread_profilers, []
+            self._report(pstats.Stats(profiler, *profilers),
+                         allocations, peak_memory, context)
+
+    def _report(self, stats, allocations, peak_memory, context):
+        functions = sorted(stats.stats.items(),
+                           key=lambda s: s[1][3], reverse=True)[:self._top]
+        logger.info(json.dumps({'Profile': {
+            'Component': self._component,
+            'PeakMemoryKiB': round(peak_memory / 1024),
+            'TopFunctions': [{'Function': f"{file}:{line}({name})", 'Calls': calls, 'CumulativeTime': round(cumulative, 4),
+                              'TotalTime': round(total, 4)} for (file, line, name), (_, calls, total, cumulative, _) in functions],
+            'TopAllocations': [{'Line': f"{a.traceback[0].filename}:{a.traceback[0].lineno}", 'SizeKiB': round(a.size / 1024, 1),
+                                'Count': a.count} for a in allocations[:self._top]]}}))
+        if self._sink is None:
+            return
+        name = f"{self._component}/{datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')}-{getattr(context, 'aws_request_id', 'local')}.prof"
+        try:
+            self._sink(name, marshal.dumps(stats.stats))
+        except Exception:
+            logger.exception(f"Error saving the profile {name}")
+
+
+# Profile sink writing the profiles to S3, under prefix
+class S3ProfileSink:
+    def __init__(self, bucket, prefix='profiles/'):
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def __call__(self, name, data):
+        retry_policy.call(get_client('s3', config=no_retries).put_object,
+                          Bucket=self._bucket, Key=self._prefix + name, Body=data)
+        logger.info(f"Profile saved to s3://{self._bucket}/{self._prefix}{name}")
+
+
+profiler = RunProfiler('Member', sink=S3ProfileSink(
+    profile_bucket) if profile_bucket else None)
+
+
+# Calls the function with args, profiled if profiling is on
+def run_profiled(context, function, *args):
+    if not (profiling or get_parameter_flag('Profiling')):
+        return function(*args)
+    with profiler.profile(context):
+        return function(*args)
+
 
 # read the current list from the master DDB account
 
 
+def refresh_remote_clients():
+    global remote_dynamodb, remote_s3, remote_credentials_expiration
+    with remote_clients_lock:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if remote_dynamodb is not None and now < remote_credentials_expiration - datetime.timedelta(seconds=credentials_refresh_margin):
+            return
+
+        role_arn = getParameters('CrossAccountAccessRoleARN')
+        logger.debug('CrossAccountAccessRole in parameter store is ' + role_arn)
+        client = get_client('sts', config=no_retries)
+        newRole = retry_policy.call(
+            client.assume_role, RoleArn=role_arn, RoleSessionName='RoleSessionName', DurationSeconds=900)
+        logger.debug('RoleArn assumed')
+        credentials = {'aws_access_key_id': newRole['Credentials']['AccessKeyId'],
+                       'aws_secret_access_key': newRole['Credentials']['SecretAccessKey'],
+                       'aws_session_token': newRole['Credentials']['SessionToken']}
+        remote_dynamodb = boto3.resource(
+            'dynamodb', region_name=my_region, config=no_retries, **credentials)
+        remote_s3 = boto3.client(
+            's3', region_name=my_region, config=no_retries, **credentials)
+        remote_credentials_expiration = newRole['Credentials']['Expiration']
+        logger.debug(
+            f"Remote credentials valid until {remote_credentials_expiration.isoformat()}")
+
+
+def get_remote_dynamodb():
+    refresh_remote_clients()
+    return remote_dynamodb
+
+
+def get_remote_s3():
+    refresh_remote_clients()
+    return remote_s3
+
+
 def get_dynamo_table(tableName):
     logger.info('Connecting to remote DynamoDB Table ' + tableName)
-    role_arn = getParameters('CrossAccountAccessRoleARN')
-    logger.debug('CrossAccountAccessRole in parameter store is ' + role_arn)
-    client = boto3.client('sts')
-    newRole = client.assume_role(
-        RoleArn=role_arn, RoleSessionName='RoleSessionName', DurationSeconds=900)
-    logger.debug('RoleArn assumed')
-    dynamodb = boto3.resource('dynamodb', region_name=my_region, aws_access_key_id=newRole['Credentials']['AccessKeyId'],
-                              aws_secret_access_key=newRole['Credentials']['SecretAccessKey'], aws_session_token=newRole['Credentials']['SessionToken'])
-    table = dynamodb.Table(tableName)
+    table = get_remote_dynamodb().Table(tableName)
     return table
 
 
-def getDynamoDBCurrentList(tableName):
-    table = get_dynamo_table(tableName)
-    response = table.scan()
+# Yields each id of a sorted iterable once
+def unique_sorted(ids):
+    previous = None
+    for id in ids:
+        if id != previous:
+            yield id
+            previous = id
+
+
+# Single pass over two sorted iterables of ids, without materializing them as sets. Yields
+# ('added', id) for the ids only in new_ids and ('removed', id) for the ids only in old_ids.
+def diff_sorted_ids(new_ids, old_ids):
+    new_ids = unique_sorted(new_ids)
+    old_ids = unique_sorted(old_ids)
+    new = next(new_ids, None)
+    old = next(old_ids, None)
+    while new is not None or old is not None:
+        if old is None or (new is not None and new < old):
+            yield 'added', new
+            new = next(new_ids, None)
+        elif new is None or old < new:
+            yield 'removed', old
+            old = next(old_ids, None)
+        else:
+            new = next(new_ids, None)
+            old = next(old_ids, None)
+
+
+# Sorted ids of the policy statements with the effect, interned so the copies of an id share one string
+def get_policy_product_ids(details, effect):
+    product_ids = [sys.intern(id) for id in policy_product_ids_expressions[effect].search(
+        details) or []]
+    product_ids.sort()
+    return product_ids
+
+
+def scan_segment_ids(table, segment=None, total_segments=1):
+    # The table's low level client is thread safe, the resource is not
+    client = table.meta.client
+    parameters = {'TableName': table.name, 'ProjectionExpression': '#id',
+                  'ExpressionAttributeNames': {'#id': 'ID'}}
+    if total_segments > 1:
+        parameters['Segment'] = segment
+        parameters['TotalSegments'] = total_segments
     IDs = []
-    for i in response['Items']:
-        IDs.append(i.get('ID'))
-        logger.debug('ID fetched: ' + i.get('ID'))
-        IDs.sort()
+    while True:
+        response = retry_policy.call(client.scan, **parameters)
+        IDs.extend(sys.intern(i['ID'])
+                   for i in response['Items'] if 'ID' in i)
+        if 'LastEvaluatedKey' not in response:
+            return IDs
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Reads all the IDs in the table following pagination, split in parallel segments if total_segments > 1
+def scan_table_ids(table, total_segments=None):
+    total_segments = total_segments or scan_segments
+    if total_segments <= 1:
+        IDs = scan_segment_ids(table)
+    else:
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(lambda segment: scan_segment_ids(
+                table, segment, total_segments), range(total_segments))
+            IDs = [id for segment_ids in segments for id in segment_ids]
+    IDs.sort()
+    return IDs
+
+
+def getDynamoDBCurrentList(tableName):
+    with metrics.phase('TableReads'):
+        table = get_dynamo_table(tableName)
+        IDs = scan_table_ids(table)
+    logger.debug(f"IDs fetched: {IDs}")
     logger.info(f"Fetched [{len(IDs)}] Ids")
     return IDs
 
 
+# Digest of both lists, it doesn't depend on the order of the ids
+def lists_digest(approved_product_ids, rejected_product_ids):
+    digest = hashlib.sha256()
+    for ids in (approved_product_ids, rejected_product_ids):
+        digest.update('\n'.join(sorted(ids)).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Both management lists from the snapshot the management function publishes, downloaded again
+# only when its ETag changed. None if it can't be read, its checksum doesn't match or it is older
+# than min_version, the tables are scanned then.
+def load_snapshot(snapshot_ref, min_version=None):
+    global snapshot_cache
+    parameters = {'Bucket': snapshot_ref['Bucket'], 'Key': snapshot_ref['Key']}
+    cached = snapshot_cache.get((parameters['Bucket'], parameters['Key']))
+    if cached is not None:
+        parameters['IfNoneMatch'] = cached['ETag']
+    try:
+        with metrics.phase('SnapshotRead'):
+            response = retry_policy.call(
+                get_remote_s3().get_object, **parameters)
+            snapshot = json.loads(gzip.decompress(response['Body'].read()))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+            logger.warning(
+                f"Snapshot {parameters['Key']} couldn't be read, scanning the tables: {e}")
+            return None
+        logger.info(f"Snapshot {parameters['Key']} not modified")
+        snapshot = cached
+    else:
+        if lists_digest(snapshot['Approved'], snapshot['Rejected']) != snapshot['Checksum']:
+            logger.warning(
+                f"Snapshot {parameters['Key']} checksum doesn't match, scanning the tables")
+            return None
+        snapshot['ETag'] = response['ETag']
+        snapshot_cache = {(parameters['Bucket'], parameters['Key']): snapshot}
+    if min_version is not None and snapshot['Version'] < min_version:
+        logger.warning(
+            f"Snapshot version {snapshot['Version']} is older than {min_version}, scanning the tables")
+        return None
+    return snapshot
+
+
+# The organization doesn't change during the life of the container
 def get_management_account_info():
-    client = boto3.client('organizations')
-    response = client.describe_organization()
-    management_account_id = response["Organization"]["MasterAccountId"]
-    management_account_email = response["Organization"]["MasterAccountEmail"]
-    return management_account_id, management_account_email
+    global management_account_info
+    if management_account_info is None:
+        client = get_client('organizations')
+        response = retry_policy.call(client.describe_organization)
+        management_account_info = (response["Organization"]["MasterAccountId"],
+                                   response["Organization"]["MasterAccountEmail"])
+    return management_account_info
 
 
-def update_sync_timestamp(tableName, context, number_of_experiences):
+# sync_index and synced_at are the keys of the time-ordered index the management reports the sync lag from
+def update_sync_timestamp(tableName, context, number_of_experiences, list_version=None, run_duration=None):
     table = get_dynamo_table(tableName)
     aws_account_id, management_account_email = get_management_account_info()
     ts = time.time()
     dt = datetime.datetime.fromtimestamp(ts).isoformat()
-    table.update_item(
+    update_expression = 'SET member_org_email =:moe, stamp =:stamp, update_time_utc =:time, experiences_updated =:exps, sync_index =:index, synced_at =:synced_at'
+    values = {
+        ':moe': str(management_account_email),
+        ':stamp': str(ts),
+        ':time': dt,
+        ':exps': number_of_experiences,
+        ':index': 'members',
+        ':synced_at': int(ts)}
+    if list_version is not None:
+        update_expression += ', list_version =:version'
+        values[':version'] = list_version
+    if run_duration is not None:
+        update_expression += ', run_duration =:duration'
+        values[':duration'] = int(round(run_duration))
+    retry_policy.call(
+        table.update_item,
         Key={'ID': aws_account_id},
-        UpdateExpression='SET member_org_email =:moe, stamp =:stamp, update_time_utc =:time, experiences_updated =:exps',
-        ExpressionAttributeValues={
-            ':moe': str(management_account_email),
-            ':stamp': str(ts),
-            ':time': dt,
-            ':exps': number_of_experiences},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=values,
     )
     logger.info(f"{tableName} updated in management org")
 
 
-def getParameters(param):
-    SSMclient = boto3.client('ssm')
-    response = SSMclient.get_parameter(Name=ssm_parameter_prefix + param)
+def load_parameters(force=False):
+    global ssm_parameters, ssm_parameters_loaded_at
+    with ssm_parameters_lock:
+        if not force and ssm_parameters_loaded_at is not None and time.time() - ssm_parameters_loaded_at < ssm_cache_ttl:
+            return ssm_parameters
+
+        SSMclient = get_client('ssm')
+        paginator = SSMclient.get_paginator('get_parameters_by_path')
+        parameters = {}
+        for page in paginator.paginate(Path=ssm_parameter_prefix.rstrip('/'), Recursive=False, WithDecryption=True):
+            for parameter in page['Parameters']:
+                parameters[parameter['Name'][len(ssm_parameter_prefix):]] = parameter['Value']
+        logger.debug(f"Parameters loaded from parameter store: {list(parameters)}")
+        ssm_parameters = parameters
+        ssm_parameters_loaded_at = time.time()
+        return ssm_parameters
+
+
+def getParameters(param, default=None):
+    value = load_parameters().get(param, default)
+    if value is None:
+        raise KeyError(
+            f"Parameter {ssm_parameter_prefix + param} wasn't found in Parameter store")
     logger.debug('Parameter name ')
     logger.debug(param)
     logger.debug('Parameter value ')
-    logger.debug(response['Parameter']['Value'])
-    return response['Parameter']['Value']
+    logger.debug(value)
+    return value
 
 
-class PMP:
+# Comma separated parameters, an empty list if the parameter doesn't exist
+def get_parameter_list(param):
+    value = getParameters(param, '')
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def get_parameter_flag(param, default=False):
+    value = getParameters(param, '')
+    if value == '':
+        return default
+    return value.lower() in ('yes', 'true', '1')
+
+
+# Messages in the SQS event, sent by the management org through SNS
+def parse_notifications(event):
+    messages = []
+    for record in (event or {}).get('Records', []):
+        try:
+            body = json.loads(record.get('body', '{}'))
+            if 'Message' in body and 'TopicArn' in body:
+                body = json.loads(body['Message'])
+        except ValueError:
+            body = {}
+        messages.append(body)
+    return messages
+
+
+# Delta of the notification, None if it has none or its stored chunks expired or can't be read
+def load_delta(message):
+    if 'Delta' in message:
+        return message['Delta']
+    if 'DeltaRef' not in message:
+        return None
+    try:
+        table = get_dynamo_table(message['DeltaRef']['Table'])
+        data = b''.join(retry_policy.call(table.get_item, Key={'ID': f"delta#{message['Version']}#{i}"})['Item']['Chunk'].value
+                        for i in range(message['DeltaRef']['Chunks']))
+        return json.loads(zlib.decompress(data))
+    except (ClientError, KeyError, ValueError, zlib.error) as e:
+        logger.warning(
+            f"Delta of version {message['Version']} couldn't be read, running a full reconciliation: {e}")
+        return None
+
+
+# Delta of applying first and then second
+def merge_deltas(first, second):
+    delta = {}
+    for name in ('Approved', 'Rejected'):
+        first_added = set(first.get(name, {}).get('Added', []))
+        first_removed = set(first.get(name, {}).get('Removed', []))
+        second_added = set(second.get(name, {}).get('Added', []))
+        second_removed = set(second.get(name, {}).get('Removed', []))
+        delta[name] = {'Added': sorted((first_added - second_removed) | second_added),
+                       'Removed': sorted((first_removed - second_added) | second_removed)}
+    return delta
+
+
+# Returns the list version of the notifications and, if they carry consecutive deltas, the combined
+# delta from the version before the first one. Without a delta the sync is a full reconciliation.
+def get_list_delta(messages):
+    messages = sorted([m for m in messages if 'Version' in m],
+                      key=lambda m: m['Version'])
+    if not len(messages):
+        return None, None
+    version = messages[-1]['Version']
+    list_delta = None
+    for message in messages:
+        if list_delta is not None and message['Version'] == list_delta['Version']:
+            continue
+        delta = load_delta(message)
+        if delta is None or (list_delta is not None and message['Version'] != list_delta['Version'] + 1):
+            return version, None
+        if list_delta is None:
+            list_delta = {'BaseVersion': message['Version'] - 1,
+                          'Version': message['Version'], 'Delta': delta}
+        else:
+            list_delta = {'BaseVersion': list_delta['BaseVersion'], 'Version': message['Version'],
+                          'Delta': merge_deltas(list_delta['Delta'], delta)}
+    return version, list_delta
+
+
+# Snapshot of the latest notification that has one
+def get_snapshot_ref(messages):
+    messages = sorted([m for m in messages if 'Snapshot' in m],
+                      key=lambda m: m.get('Version', 0))
+    return messages[-1]['Snapshot'] if len(messages) else None
+
+
+# Token bucket shared by the threads using a client, every API call takes a token
+class RateLimiter:
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens +
+                                   (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self._rate
+            with metrics.phase('RateLimitWait'):
+                time.sleep(wait_time)
+
+    # botocore before-call handler, so waiters and paginators are throttled as well
+    def before_call(self, **kwargs):
+        self.acquire()
+
+
+# Request token of a change set, the same for the same changes in the same sync so the catalog
+# returns the change set it already accepted instead of starting a duplicate. scope identifies the
+# sync, a later sync making the same changes gets new tokens, and attempt tells the resubmissions
+# of the changes apart.
+def change_set_token(scope, changes, attempt=0):
+    digest = hashlib.sha256(json.dumps([scope, attempt, [[experience_id, change_type, sorted(product_ids)] for experience_id, change_type, product_ids in changes]],
+                                       separators=(',', ':')).encode()).digest()
+    return str(uuid.UUID(bytes=digest[:16]))
+
+
+# Keeps several change sets in flight and polls them together. The catalog rejects concurrent
+# change sets on the same entity, an experience is in one change set in flight at most. The poll
+# interval follows an EWMA of the observed change set durations.
+# StartChangeSet accepts one change of each type per entity, so a change set takes one Allow and
+# one Deny change of an experience at most, and the queued experiences are packed together into
+# change sets of up to max_changes changes. The products per change grow after every successful
+# change set and are halved after a failed one. The experiences of a failed change set are retried
+# in change sets of their own, so one experience can't keep failing the others.
+class ChangeSetPipeline:
+    min_poll_interval = 2
+    max_poll_interval = 30
+    initial_expected_duration = 30.0
+    ewma_alpha = 0.3
+    max_attempts = 3
+    batch_size_step = 10
+    # A change set started this long before it was submitted was started by an earlier request
+    reused_change_set_slack = 60
+
+    def __init__(self, client, max_in_flight, batch_size=None, max_changes=None, on_progress=None):
+        self._client = client
+        self._max_in_flight = max_in_flight
+        # Called with the experience and its remaining changes after each successful change set
+        self._on_progress = on_progress
+        self._batch_size = batch_size or change_batch_size
+        self._max_changes = max_changes or max_changes_per_change_set
+        self._queues = {}
+        self._in_flight = {}
+        self._failures = {}
+        self._resubmissions = {}
+        self._errors = {}
+        self._expected_duration = self.initial_expected_duration
+        self._checked_experiences = set()
+        # Scope of the request tokens, the sync set with set_sync_id or this pipeline's own
+        self._token_scope = str(uuid.uuid4())
+        self._lock = threading.Lock()
+
+    # The change sets of a sync resumed in a later invocation get the same request tokens
+    def set_sync_id(self, sync_id):
+        if sync_id is not None:
+            self._token_scope = str(sync_id)
+
+    def submit(self, experience_id, change_type, product_ids):
+        with self._lock:
+            queue = self._queues.setdefault(experience_id, deque())
+            if len(queue) and queue[-1][0] == change_type:
+                queue[-1][1].extend(product_ids)
+            else:
+                queue.append((change_type, list(product_ids)))
+
+    def poll_interval(self):
+        return min(self.max_poll_interval, max(self.min_poll_interval, self._expected_duration / 4))
+
+    # Drives the queued change sets until all of them finished, returns the errors per experience.
+    # Raises DeadlineExceeded when the invocation is about to time out, the change sets in flight
+    # keep being applied by the catalog.
+    def run(self):
+        self._adopt_open_change_sets()
+        while True:
+            with self._lock:
+                if not self._in_flight and not any(self._queues.values()):
+                    errors, self._errors = self._errors, {}
+                    return errors
+            if remaining_time() < deadline_margin:
+                raise DeadlineExceeded(
+                    f"[{len(self._in_flight)}] change sets still in flight")
+            self._start_queued()
+            if not self._in_flight and not self._can_start():
+                raise DeadlineExceeded(
+                    "Not enough time left to start the queued change sets")
+            self._poll_in_flight()
+            next_poll_at = min((c['NextPollAt'] for c in self._in_flight.values()),
+                               default=time.monotonic() + self.min_poll_interval)
+            with metrics.phase('ChangeSetWait'):
+                time.sleep(max(0, min(next_poll_at - time.monotonic(),
+                                      remaining_time() - deadline_margin)))
+
+    # Change sets of the queued experiences that are still applying, started by a run that timed out
+    # or by a retried request, are polled as if this run had started them. Their products are
+    # removed from the queues, the experiences' other changes wait until they finish.
+    def _adopt_open_change_sets(self):
+        with self._lock:
+            experience_ids = {e for e, queue in self._queues.items()
+                              if len(queue)} - self._checked_experiences
+            self._checked_experiences |= experience_ids
+        if not len(experience_ids):
+            return
+        parameters = {'Catalog': 'AWSMarketplace', 'FilterList': [
+            {'Name': 'Status', 'ValueList': ['PREPARING', 'APPLYING']}]}
+        open_change_sets = {}
+        while True:
+            response = retry_policy.call(
+                self._client.list_change_sets, **parameters)
+            for summary in response.get('ChangeSetSummaryList', []):
+                entity_ids = experience_ids & set(
+                    summary.get('EntityIdList', []))
+                if summary.get('Status') in ('PREPARING', 'APPLYING') and summary['ChangeSetId'] not in self._in_flight and len(entity_ids):
+                    open_change_sets[summary['ChangeSetId']] = entity_ids
+            if 'NextToken' not in response:
+                break
+            parameters['NextToken'] = response['NextToken']
+
+        for change_set_id, adopted_experience_ids in open_change_sets.items():
+            response = retry_policy.call(
+                self._client.describe_change_set, Catalog='AWSMarketplace', ChangeSetId=change_set_id)
+            changes = []
+            for change in response.get('ChangeSet', []):
+                if change['Entity']['Identifier'] not in adopted_experience_ids or change['ChangeType'] not in ('AllowProductProcurement', 'DenyProductProcurement'):
+                    continue
+                details = json.loads(change['Details']) if 'Details' in change else change.get(
+                    'DetailsDocument', {})
+                changes.append((change['Entity']['Identifier'], change['ChangeType'], [
+                               i for p in details.get('Products', []) for i in p.get('Ids', [])]))
+            with self._lock:
+                for experience_id, change_type, product_ids in changes:
+                    queue = self._queues[experience_id]
+                    in_flight_ids = set(product_ids)
+                    for i, (queued_type, queued_ids) in enumerate(queue):
+                        if queued_type == change_type:
+                            queue[i] = (queued_type, [
+                                        p for p in queued_ids if p not in in_flight_ids])
+                for experience_id in adopted_experience_ids:
+                    queue = self._queues[experience_id]
+                    for queued in [q for q in queue if not len(q[1])]:
+                        queue.remove(queued)
+            now = time.monotonic()
+            self._in_flight[change_set_id] = {
+                'Experiences': sorted(adopted_experience_ids),
+                'Changes': changes,
+                'SubmittedAt': None,
+                'NextPollAt': now}
+            logger.info(
+                f"Change set {change_set_id} of {', '.join(sorted(adopted_experience_ids))} still {response['Status']}, adopted with [{sum(len(c[2]) for c in changes)}] products")
+
+    # A change set is only started if it can be expected to finish before the deadline
+    def _can_start(self):
+        return remaining_time() > deadline_margin + self._expected_duration
+
+    # Takes up to limit changes of batch_size products from the front of the experience's queue,
+    # the next change only once the front one is emptied so the changes keep their order, and one
+    # change of each type at most
+    def _next_changes(self, experience_id, queue, limit):
+        changes = []
+        while len(queue) and len(changes) < limit and queue[0][0] not in {c[1] for c in changes}:
+            change_type, product_ids = queue[0]
+            changes.append(
+                (experience_id, change_type, product_ids[:self._batch_size]))
+            del product_ids[:self._batch_size]
+            if len(product_ids):
+                break
+            queue.popleft()
+        return changes
+
+    def _requeue(self, changes):
+        for experience_id, change_type, product_ids in reversed(changes):
+            queue = self._queues[experience_id]
+            if len(queue) and queue[0][0] == change_type:
+                queue[0] = (change_type, product_ids + queue[0][1])
+            else:
+                queue.appendleft((change_type, list(product_ids)))
+
+    # Packs the changes of the experiences that aren't in a change set in flight into new change sets,
+    # an experience that failed before goes alone
+    def _start_queued(self):
+        with self._lock:
+            busy_experiences = {e for c in self._in_flight.values()
+                                for e in c['Experiences']}
+            ready = [e for e in sorted(self._queues)
+                     if len(self._queues[e]) and e not in busy_experiences]
+            while len(ready) and len(self._in_flight) < self._max_in_flight and self._can_start():
+                changes = []
+                for experience_id in list(ready):
+                    if len(changes) >= self._max_changes:
+                        break
+                    isolated = self._failures.get(experience_id, 0) > 0
+                    if len(changes) and isolated:
+                        continue
+                    ready.remove(experience_id)
+                    changes.extend(self._next_changes(
+                        experience_id, self._queues[experience_id], self._max_changes - len(changes)))
+                    if isolated:
+                        break
+                if not self._start(changes):
+                    # An experience is busy, we are throttled or the error is transient, try again after the next poll
+                    self._requeue(changes)
+
+    def _start(self, changes):
+        experience_ids = sorted({c[0] for c in changes})
+        kargs = {
+            'Catalog': 'AWSMarketplace',
+            'ChangeSet': [
+                {
+                    'ChangeType': change_type,
+                    'Entity': {
+                        'Type': 'Experience@1.0',
+                        'Identifier': experience_id
+                    },
+                    'Details': json.dumps({'Products': [{"Ids": product_ids}]}),
+                } for experience_id, change_type, product_ids in changes
+            ],
+            'ClientRequestToken': change_set_token(self._token_scope, changes,
+                                                   sum(self._failures.get(e, 0) + self._resubmissions.get(e, 0) for e in experience_ids))
+        }
+        try:
+            response = self._client.start_change_set(**kargs)
+        except Exception as e:
+            error_class = RetryPolicy.classify(e)
+            if error_class != 'permanent':
+                logger.info(
+                    f"Change set for {', '.join(experience_ids)} deferred after a {error_class} error: {e}")
+                return False
+            if len(experience_ids) > 1:
+                # The changes of one experience can reject the change set, they are started alone
+                logger.warning(
+                    f"Change set for [{len(experience_ids)}] experiences rejected, starting them one by one: {e}")
+                for experience_id in experience_ids:
+                    self._failures[experience_id] = self._failures.get(
+                        experience_id, 0) + 1
+                return False
+            logger.error(e)
+            self._errors[experience_ids[0]] = e
+            self._queues[experience_ids[0]].clear()
+            return True
+
+        now = time.monotonic()
+        self._in_flight[response['ChangeSetId']] = {
+            'Experiences': experience_ids,
+            'Changes': changes,
+            'SubmittedAt': now,
+            'SubmittedAtUtc': time.time(),
+            'NextPollAt': now + max(self.min_poll_interval, self._expected_duration / 2)}
+        logger.info(
+            f"Change set {response['ChangeSetId']} started: [{len(changes)}] changes, [{sum(len(c[2]) for c in changes)}] products in {', '.join(experience_ids)}")
+        return True
+
+    def _started_before_submission(self, response, change_set):
+        if change_set['SubmittedAt'] is None or 'StartTime' not in response:
+            return False
+        started_at = response['StartTime']
+        if isinstance(started_at, str):
+            started_at = datetime.datetime.fromisoformat(
+                started_at.replace('Z', '+00:00'))
+        return started_at.timestamp() < change_set['SubmittedAtUtc'] - self.reused_change_set_slack
+
+    def _poll_in_flight(self):
+        now = time.monotonic()
+        for change_set_id, change_set in list(self._in_flight.items()):
+            if change_set['NextPollAt'] > now:
+                continue
+            response = retry_policy.call(
+                self._client.describe_change_set, Catalog='AWSMarketplace', ChangeSetId=change_set_id)
+            status = response['Status']
+            if 'Reused' not in change_set:
+                change_set['Reused'] = status not in (
+                    'PREPARING', 'APPLYING') and self._started_before_submission(response, change_set)
+            if status in ('PREPARING', 'APPLYING'):
+                change_set['NextPollAt'] = time.monotonic() + \
+                    self.poll_interval()
+                continue
+
+            del self._in_flight[change_set_id]
+            experience_ids = change_set['Experiences']
+            if change_set['Reused']:
+                # The token matched a change set finished before this submission, its changes
+                # weren't applied by this run
+                logger.warning(
+                    f"Change set {change_set_id} had already {status} before it was submitted, resubmitting its changes")
+                with self._lock:
+                    for experience_id in experience_ids:
+                        self._resubmissions[experience_id] = self._resubmissions.get(
+                            experience_id, 0) + 1
+                    self._requeue(change_set['Changes'])
+                continue
+            if change_set['SubmittedAt'] is not None:
+                duration = time.monotonic() - change_set['SubmittedAt']
+                self._expected_duration += self.ewma_alpha * \
+                    (duration - self._expected_duration)
+            with self._lock:
+                if status == 'SUCCEEDED':
+                    logger.info(
+                        f"Change set {change_set_id} succeeded" + (f" in {duration:.1f} secs" if change_set['SubmittedAt'] is not None else ''))
+                    for experience_id in experience_ids:
+                        self._failures.pop(experience_id, None)
+                    self._batch_size = min(
+                        max_change_batch_size, self._batch_size + self.batch_size_step)
+                    remaining_changes = {experience_id: [(change_type, list(product_ids))
+                                                         for change_type, product_ids in self._queues[experience_id]]
+                                         for experience_id in experience_ids}
+                else:
+                    remaining_changes = None
+            if remaining_changes is not None:
+                if self._on_progress:
+                    for experience_id, changes in remaining_changes.items():
+                        self._on_progress(experience_id, changes)
+                continue
+
+            with self._lock:
+                logger.error(
+                    f"Change set {change_set_id} {status}: {response.get('FailureDescription', '')}")
+                self._batch_size = max(
+                    min_change_batch_size, self._batch_size // 2)
+                retried_experience_ids = set()
+                for experience_id in experience_ids:
+                    self._failures[experience_id] = self._failures.get(
+                        experience_id, 0) + 1
+                    if self._failures[experience_id] < self.max_attempts:
+                        retried_experience_ids.add(experience_id)
+                    else:
+                        self._errors[experience_id] = RuntimeError(
+                            f"Change set {change_set_id} {status} after {self._failures.pop(experience_id)} attempts")
+                        self._queues[experience_id].clear()
+                if len(retried_experience_ids):
+                    logger.info(
+                        f"Retrying the changes of {change_set_id} with [{self._batch_size}] products per change")
+                    self._requeue(
+                        [c for c in change_set['Changes'] if c[0] in retried_experience_ids])
+
+
+# Progress of a member sync stored in the local sync state table, so a sync stopped by the
+# Lambda timeout is resumed by the next invocation instead of starting over. It keeps the
+# experiences of the sync, the ones already synced and the pending changes of the others,
+# compressed, so they are applied without reading the remote tables again.
+class SyncCheckpoint:
+    def __init__(self, table_name, max_age=None):
+        self._table = get_local_table(table_name)
+        self._max_age = max_age or checkpoint_max_age
+        self._lock = threading.Lock()
+        self.experience_ids = []
+        self.completed = set()
+        self.started_at = None
+        self._abandoned_experience_ids = []
+        # Experiences that may have pending changes stored, deleted by finish
+        self._pending_experience_ids = set()
+
+    # Loads the checkpoint of an unfinished sync of the same list version, False if there is none,
+    # it is too old or it was planned against another version. The pending changes of an
+    # abandoned checkpoint are cleared by start.
+    def resume(self, list_version=None):
+        item = retry_policy.call(self._table.get_item, Key={
+                                 'ID': 'checkpoint'}, ConsistentRead=True).get('Item')
+        if item is None:
+            return False
+        checkpoint_version = int(
+            item['ListVersion']) if 'ListVersion' in item else None
+        if time.time() - float(item['StartedAt']) > self._max_age or checkpoint_version != list_version:
+            logger.info(
+                f"Abandoning the sync checkpoint of list version {checkpoint_version}")
+            self._abandoned_experience_ids = sorted(
+                set(item['Experiences']) - set(item.get('Completed', [])))
+            return False
+        self.experience_ids = list(item['Experiences'])
+        self.completed = set(item.get('Completed', []))
+        self.started_at = float(item['StartedAt'])
+        self._pending_experience_ids = set(
+            self.experience_ids) - self.completed
+        return True
+
+    def start(self, experience_ids, list_version=None):
+        for experience_id in self._abandoned_experience_ids:
+            retry_policy.call(self._table.delete_item, Key={
+                              'ID': 'checkpoint#' + experience_id})
+        self._abandoned_experience_ids = []
+        self.experience_ids = list(experience_ids)
+        self.completed = set()
+        self._pending_experience_ids = set()
+        self.started_at = time.time()
+        item = {
+            'ID': 'checkpoint',
+            'StartedAt': str(self.started_at),
+            'Experiences': self.experience_ids,
+            'ExpiresAt': int(self.started_at + self._max_age)}
+        if list_version is not None:
+            item['ListVersion'] = list_version
+        retry_policy.call(self._table.put_item, Item=item)
+
+    def get_pending_changes(self, experience_id):
+        item = retry_policy.call(self._table.get_item, Key={
+                                 'ID': 'checkpoint#' + experience_id}, ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        data = item['Changes'].value + b''.join(retry_policy.call(self._table.get_item, Key={'ID': f"checkpoint#{experience_id}#{i}"}, ConsistentRead=True)['Item']['Chunk'].value
+                                                for i in range(1, int(item.get('Chunks', 1))))
+        return [tuple(change) for change in json.loads(zlib.decompress(data))]
+
+    # The compressed changes are split in chunks below the item size limit, the first one is kept
+    # in the experience's item and the others are written before it
+    def save_pending_changes(self, experience_id, changes):
+        if not len(changes):
+            self.complete_experience(experience_id)
+            return
+        data = zlib.compress(json.dumps(changes).encode())
+        chunks = [data[i:i + checkpoint_chunk_size]
+                  for i in range(0, len(data), checkpoint_chunk_size)]
+        expires_at = int(self.started_at + self._max_age)
+        with self._lock:
+            self._pending_experience_ids.add(experience_id)
+        for i, chunk in enumerate(chunks[1:], 1):
+            retry_policy.call(self._table.put_item, Item={
+                'ID': f"checkpoint#{experience_id}#{i}", 'Chunk': chunk, 'ExpiresAt': expires_at})
+        retry_policy.call(self._table.put_item, Item={
+            'ID': 'checkpoint#' + experience_id,
+            'Changes': chunks[0],
+            'Chunks': len(chunks),
+            'ExpiresAt': expires_at})
+
+    def complete_experience(self, experience_id):
+        with self._lock:
+            self.completed.add(experience_id)
+            self._pending_experience_ids.discard(experience_id)
+        retry_policy.call(self._table.update_item,
+                          Key={'ID': 'checkpoint'},
+                          UpdateExpression='ADD Completed :e',
+                          ExpressionAttributeValues={':e': {experience_id}})
+        retry_policy.call(self._table.delete_item, Key={
+                          'ID': 'checkpoint#' + experience_id})
+
+    def finish(self):
+        for experience_id in sorted(self._pending_experience_ids):
+            retry_policy.call(self._table.delete_item, Key={
+                              'ID': 'checkpoint#' + experience_id})
+        retry_policy.call(self._table.delete_item, Key={'ID': 'checkpoint'})
+        logger.info("Sync checkpoint cleared")
+
+
+# Version of the management lists last applied to each experience, kept in the local sync state table
+class ListVersionStore:
+    def __init__(self, table_name):
+        self._table = get_local_table(table_name)
+
+    def get(self, experience_id):
+        item = retry_policy.call(self._table.get_item, Key={
+                                 'ID': 'list-version#' + experience_id}, ConsistentRead=True).get('Item')
+        return int(item['Version']) if item else None
+
+    def set(self, experience_id, version):
+        retry_policy.call(self._table.put_item, Item={
+                          'ID': 'list-version#' + experience_id, 'Version': version})
+
+
+# What each experience was last synced from: the digest of the remote lists and the last modified
+# date of its procurement policy after the sync, kept in the local sync state table
+class ExperienceFingerprints:
+    def __init__(self, table_name):
+        self._table = get_local_table(table_name)
+
+    def get(self, experience_id):
+        return retry_policy.call(self._table.get_item, Key={
+                                 'ID': 'fingerprint#' + experience_id}, ConsistentRead=True).get('Item')
+
+    def set(self, experience_id, remote_digest, policy_id, policy_last_modified):
+        retry_policy.call(self._table.put_item, Item={
+                          'ID': 'fingerprint#' + experience_id,
+                          'RemoteDigest': remote_digest,
+                          'PolicyId': policy_id,
+                          'PolicyLastModified': policy_last_modified})
+
+
+# Single-flight lock of the syncs, kept in the local sync state table. The lease lasts until the
+# invocation of its owner times out, the notifications that other invocations receive while it is
+# held are stored in the lease, without their inline deltas, for the owner to run them next.
+class SyncLease:
+    def __init__(self, table_name, context=None, owner=None):
+        self._table = get_local_table(table_name)
+        self.owner = owner or getattr(
+            context, 'aws_request_id', None) or str(uuid.uuid4())
+
+    def _expires_at(self):
+        duration = remaining_time()
+        if duration == float('inf'):
+            duration = lease_duration
+        return int(time.time() + duration + deadline_margin)
+
+    # Returns the notifications deferred to the new owner, None if the lease is held
+    def acquire(self):
+        try:
+            response = retry_policy.call(self._table.update_item,
+                                         Key={'ID': 'lease'},
+                                         UpdateExpression='SET #owner = :owner, ExpiresAt = :expires_at REMOVE Pending',
+                                         ConditionExpression='attribute_not_exists(ID) OR ExpiresAt < :now',
+                                         ExpressionAttributeNames={
+                                             '#owner': 'Owner'},
+                                         ExpressionAttributeValues={':owner': self.owner, ':expires_at': self._expires_at(),
+                                                                    ':now': int(time.time())},
+                                         ReturnValues='ALL_OLD')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return [json.loads(m) for m in response.get('Attributes', {}).get('Pending', [])]
+
+    # Stores the notifications for the owner, False if the lease isn't held anymore
+    def defer(self, messages):
+        pending = [json.dumps({k: v for k, v in m.items() if k != 'Delta'})
+                   for m in messages]
+        try:
+            retry_policy.call(self._table.update_item,
+                              Key={'ID': 'lease'},
+                              UpdateExpression='SET Pending = list_append(if_not_exists(Pending, :empty), :pending)',
+                              ConditionExpression='attribute_exists(ID) AND ExpiresAt >= :now',
+                              ExpressionAttributeValues={':empty': [], ':pending': pending or [json.dumps({})],
+                                                         ':now': int(time.time())})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    # Releases the lease, unless notifications were deferred to it: they are returned and the lease is kept
+    def release(self):
+        try:
+            retry_policy.call(self._table.delete_item,
+                              Key={'ID': 'lease'},
+                              ConditionExpression='#owner = :owner AND attribute_not_exists(Pending)',
+                              ExpressionAttributeNames={'#owner': 'Owner'},
+                              ExpressionAttributeValues={':owner': self.owner})
+            return []
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        try:
+            response = retry_policy.call(self._table.update_item,
+                                         Key={'ID': 'lease'},
+                                         UpdateExpression='SET ExpiresAt = :expires_at REMOVE Pending',
+                                         ConditionExpression='#owner = :owner',
+                                         ExpressionAttributeNames={
+                                             '#owner': 'Owner'},
+                                         ExpressionAttributeValues={':owner': self.owner,
+                                                                    ':expires_at': self._expires_at()},
+                                         ReturnValues='UPDATED_OLD')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.warning("The sync lease expired before it was released")
+            return []
+        return [json.loads(m) for m in response.get('Attributes', {}).get('Pending', [])]
+
+    # Keeps the lease for seconds from now, for the workers of a fanned out sync
+    def extend(self, seconds):
+        retry_policy.call(self._table.update_item,
+                          Key={'ID': 'lease'},
+                          UpdateExpression='SET ExpiresAt = :expires_at',
+                          ConditionExpression='#owner = :owner',
+                          ExpressionAttributeNames={'#owner': 'Owner'},
+                          ExpressionAttributeValues={':owner': self.owner,
+                                                     ':expires_at': int(time.time() + seconds)})
+
+    # Gives the lease up keeping the deferred notifications for the next owner
+    def abandon(self, messages=()):
+        if len(messages):
+            self.defer(messages)
+        try:
+            retry_policy.call(self._table.update_item,
+                              Key={'ID': 'lease'},
+                              UpdateExpression='SET ExpiresAt = :expired',
+                              ConditionExpression='#owner = :owner',
+                              ExpressionAttributeNames={'#owner': 'Owner'},
+                              ExpressionAttributeValues={':owner': self.owner, ':expired': 0})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+# Progress of a fanned out sync, kept in the local sync state table. The workers record the result
+# of their experience and the last one to complete the run updates the sync timestamp.
+class FanOutRun:
+    def __init__(self, table_name):
+        self._table = get_local_table(table_name)
+
+    # Stores the lists version, the combined delta and the remote lists the run syncs to once, in
+    # compressed chunks. Returns the reference the work items carry instead of the notifications.
+    def start(self, run_id, experience_ids, skipped, lease_owner, lists):
+        expires_at = int(time.time() + fan_out_timeout)
+        data = zlib.compress(json.dumps(lists).encode())
+        chunks = [data[i:i + fan_out_chunk_size]
+                  for i in range(0, len(data), fan_out_chunk_size)]
+        for i, chunk in enumerate(chunks):
+            retry_policy.call(self._table.put_item, Item={
+                'ID': f"run#{run_id}#lists#{i}", 'Chunk': chunk, 'ExpiresAt': expires_at})
+        retry_policy.call(self._table.put_item, Item={
+            'ID': 'run#' + run_id,
+            'Experiences': len(experience_ids),
+            'Skipped': skipped,
+            'LeaseOwner': lease_owner,
+            'StartedAt': str(time.time()),
+            'ExpiresAt': expires_at})
+        return {'Key': f"run#{run_id}#lists", 'Chunks': len(chunks)}
+
+    # Lists of the run, read once per container
+    def load_lists(self, lists_ref):
+        global fan_out_lists_cache
+        if lists_ref['Key'] not in fan_out_lists_cache:
+            data = b''.join(retry_policy.call(self._table.get_item, Key={'ID': f"{lists_ref['Key']}#{i}"})['Item']['Chunk'].value
+                            for i in range(lists_ref['Chunks']))
+            fan_out_lists_cache = {lists_ref['Key']: json.loads(zlib.decompress(data))}
+        return fan_out_lists_cache[lists_ref['Key']]
+
+    # Records the result of the experience, returns the run if this completed it
+    def complete(self, run_id, experience_id, succeeded):
+        try:
+            run = retry_policy.call(self._table.update_item,
+                                    Key={'ID': 'run#' + run_id},
+                                    UpdateExpression='ADD #results :e',
+                                    ConditionExpression='attribute_exists(ID)',
+                                    ExpressionAttributeNames={
+                                        '#results': 'Succeeded' if succeeded else 'Failed'},
+                                    ExpressionAttributeValues={
+                                        ':e': {experience_id}},
+                                    ReturnValues='ALL_NEW')['Attributes']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.warning(f"Sync run {run_id} expired")
+            return None
+        if len(run.get('Succeeded', ())) + len(run.get('Failed', ())) < run['Experiences']:
+            return None
+        try:
+            retry_policy.call(self._table.update_item,
+                              Key={'ID': 'run#' + run_id},
+                              UpdateExpression='SET Finished = :finished',
+                              ConditionExpression='attribute_not_exists(Finished)',
+                              ExpressionAttributeValues={':finished': str(time.time())})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return run
+
+
+# Queue of the work items of the fanned out syncs. Anything with a send(items) method can stand in
+# for it, to run the orchestrator and the workers locally.
+class WorkQueue:
+    def __init__(self, queue_url):
+        self._queue_url = queue_url
+
+    def send(self, items):
+        client = get_client('sqs')
+        for i in range(0, len(items), 10):
+            entries = [{'Id': str(j), 'MessageBody': json.dumps(item)}
+                       for j, item in enumerate(items[i:i + 10])]
+            attempt = 0
+            while len(entries):
+                response = retry_policy.call(
+                    client.send_message_batch, QueueUrl=self._queue_url, Entries=entries)
+                failed = {f['Id'] for f in response.get('Failed', [])}
+                entries = [e for e in entries if e['Id'] in failed]
+                if len(entries):
+                    attempt += 1
+                    if attempt >= retry_max_attempts:
+                        raise RuntimeError(
+                            f"[{len(entries)}] work items couldn't be sent to the work queue")
+                    time.sleep(retry_policy.delay('throttling', attempt))
+
+
+work_queue = WorkQueue(work_queue_url) if work_queue_url else None
+
+
+# Shared by the threads and the warm invocations using the catalog client
+catalog_rate_limiter = RateLimiter(catalog_api_rate, catalog_api_burst)
+
+
+# Account id to audience to experience index built from all the Audience entities
+class AudienceIndex:
     def __init__(self):
-        self._client = boto3.client(
-            'marketplace-catalog', region_name='us-east-1')
-        self._batch_size = 50
+        self._accounts = {}
+        self._built_at = None
+
+    def is_fresh(self):
+        return self._built_at is not None and time.time() - self._built_at < audience_index_ttl
+
+    def build(self, pmp):
+        audiences = pmp.describe_entities(pmp.get_audiences())
+        accounts = {}
+        for audience_id, audience in audiences.items():
+            details = audience['DetailsDocument']
+            for principal in details.get('Principals', []):
+                if isinstance(principal, str):
+                    accounts.setdefault(principal, {})[
+                        audience_id] = details.get('ExperienceId')
+        self._accounts = accounts
+        self._built_at = time.time()
+        logger.info(
+            f"Audience index built with [{len(audiences)}] audiences and [{len(accounts)}] principals")
+
+    def invalidate(self):
+        self._built_at = None
+
+    def get_audiences(self, account_id):
+        return dict(self._accounts.get(account_id, {}))
+
+    def get_experiences(self, account_id):
+        return set(self._accounts.get(account_id, {}).values())
+
+    def get_coverage(self):
+        return {account_id: set(audiences.values()) for account_id, audiences in self._accounts.items()}
+
+
+class PMP:
+    def __init__(self, concurrency=None, checkpoint=None, list_versions=None, fingerprints=None, snapshot=None, remote_lists=None):
+        self._client = get_client('marketplace-catalog', region_name='us-east-1', config=no_retries,
+                                  setup=lambda client: client.meta.events.register(
+                                      'before-call.marketplace-catalog', catalog_rate_limiter.before_call))
+        self._concurrency = concurrency or sync_concurrency
+        self._checkpoint = checkpoint
+        self._list_versions = list_versions
+        self._fingerprints = fingerprints
+        self._policy_ids = {}
+        # Entities described in this run, with their details parsed once
+        self._entities = {}
+        self._entities_lock = threading.Lock()
+        self._batch_describe = hasattr(
+            self._client, 'batch_describe_entities')
+        self._policy_last_modified = None
+        self._policy_last_modified_lock = threading.Lock()
+        self._change_sets = ChangeSetPipeline(
+            self._client, max_change_sets_in_flight,
+            on_progress=checkpoint.save_pending_changes if checkpoint else None)
+        self._remote_products_ids_lock = threading.Lock()
+        # Reference and minimum version of the lists snapshot, read instead of the tables
+        self._snapshot = snapshot
         self._experience_ids = []
         self._remote_approved_products_ids = []
         self._remote_rejected_products_ids = []
         self._remote_approved_products_ids_cached = False
         self._remote_rejected_products_ids_cached = False
+        self._remote_digest = None
+        self._remote_digest_lock = threading.Lock()
+        # Remote lists already read by the orchestrator of a fanned out sync
+        if remote_lists is not None:
+            (self._remote_approved_products_ids,
+             self._remote_rejected_products_ids) = remote_lists
+            self._remote_approved_products_ids_cached = True
+            self._remote_rejected_products_ids_cached = True
+
+    # Caches both lists from the snapshot, once
+    def _load_remote_snapshot(self):
+        if self._snapshot is None:
+            return
+        snapshot = load_snapshot(
+            self._snapshot['Ref'], self._snapshot.get('MinVersion'))
+        self._snapshot = None
+        if snapshot is None:
+            return
+        logger.info(
+            f"Lists version {snapshot['Version']} read from the snapshot")
+        self._remote_approved_products_ids = snapshot['Approved']
+        self._remote_rejected_products_ids = snapshot['Rejected']
+        self._remote_approved_products_ids_cached = True
+        self._remote_rejected_products_ids_cached = True
 
     def get_remote_approved_products_ids(self, remote_approved_table_name):
-        if self._remote_approved_products_ids_cached:
-            return (self._remote_approved_products_ids)
+        with self._remote_products_ids_lock:
+            self._load_remote_snapshot()
+            if self._remote_approved_products_ids_cached:
+                return (self._remote_approved_products_ids)
 
-        self._remote_approved_products_ids = getDynamoDBCurrentList(
-            remote_approved_table_name)
-        self._remote_approved_products_ids_cached = True
-        return (self._remote_approved_products_ids)
+            self._remote_approved_products_ids = getDynamoDBCurrentList(
+                remote_approved_table_name)
+            self._remote_approved_products_ids_cached = True
+            return (self._remote_approved_products_ids)
 
     def get_remote_rejected_products_ids(self, remote_rejected_table_name):
-        if self._remote_rejected_products_ids_cached:
-            return (self._remote_rejected_products_ids)
+        with self._remote_products_ids_lock:
+            self._load_remote_snapshot()
+            if self._remote_rejected_products_ids_cached:
+                return (self._remote_rejected_products_ids)
 
-        self._remote_rejected_products_ids = getDynamoDBCurrentList(
-            remote_rejected_table_name)
-        self._remote_rejected_products_ids_cached = True
-        return (self._remote_rejected_products_ids)
+            self._remote_rejected_products_ids = getDynamoDBCurrentList(
+                remote_rejected_table_name)
+            self._remote_rejected_products_ids_cached = True
+            return (self._remote_rejected_products_ids)
 
     def get_proc_policy(self, experience_id):
         experience = self.get_experience(experience_id)
-        procpolicy = (json.loads(experience['Details']))[
-            'ProcurementPolicies'][0]
+        procpolicy = experience['DetailsDocument']['ProcurementPolicies'][0]
+        self._policy_ids[experience_id] = procpolicy
         return (procpolicy)
 
+    # Describes the entities that aren't cached yet, in batches of up to 20 when the API supports it,
+    # and returns them with their details parsed
+    def describe_entities(self, entity_ids):
+        with metrics.phase('CatalogReads'):
+            with self._entities_lock:
+                missing = [
+                    e for e in dict.fromkeys(entity_ids) if e not in self._entities]
+            if self._batch_describe:
+                for i in range(0, len(missing), 20):
+                    try:
+                        response = retry_policy.call(self._client.batch_describe_entities, EntityRequestList=[
+                                                     {'Catalog': 'AWSMarketplace', 'EntityId': e} for e in missing[i:i + 20]])
+                    except ClientError as e:
+                        logger.info(
+                            f"BatchDescribeEntities not available, describing entities one by one: {e}")
+                        self._batch_describe = False
+                        break
+                    with self._entities_lock:
+                        for entity_id, entity in response.get('EntityDetails', {}).items():
+                            self._entities[entity_id] = {'EntityId': entity_id,
+                                                         'LastModifiedDate': entity.get('LastModifiedDate'),
+                                                         'DetailsDocument': entity['DetailsDocument']}
+            # Entities the batch couldn't describe raise their error here
+            for entity_id in missing:
+                if entity_id in self._entities:
+                    continue
+                response = retry_policy.call(
+                    self._client.describe_entity, Catalog='AWSMarketplace', EntityId=entity_id)
+                with self._entities_lock:
+                    self._entities[entity_id] = {'EntityId': entity_id,
+                                                 'LastModifiedDate': response.get('LastModifiedDate'),
+                                                 'DetailsDocument': json.loads(response['Details'])}
+            return {e: self._entities[e] for e in entity_ids}
+
+    def get_entity(self, entity_id):
+        return self.describe_entities([entity_id])[entity_id]
+
+    # Describes the experiences and then their procurement policies in batches before they are planned
+    def prefetch_policies(self, experience_ids):
+        experiences = self.describe_entities(experience_ids)
+        policy_ids = []
+        for experience in experiences.values():
+            policies = experience['DetailsDocument'].get(
+                'ProcurementPolicies', [])
+            if len(policies):
+                policy_ids.append(policies[0])
+        self.describe_entities(policy_ids)
+
+    # Last modified date of every procurement policy, listed once per run instead of describing each policy
+    def get_policies_last_modified(self, refresh=False):
+        with self._policy_last_modified_lock:
+            if self._policy_last_modified is not None and not refresh:
+                return self._policy_last_modified
+            parameters = {'Catalog': 'AWSMarketplace', 'EntityType': "ProcurementPolicy", 'FilterList': [
+                {'Name': 'Scope', 'ValueList': ['SharedWithMe']}]}
+            policies = {}
+            while True:
+                response = retry_policy.call(
+                    self._client.list_entities, **parameters)
+                for e in response.get('EntitySummaryList', []):
+                    policies[e.get('EntityId')] = e.get('LastModifiedDate')
+                if "NextToken" not in response:
+                    break
+                parameters["NextToken"] = response.get('NextToken')
+            self._policy_last_modified = policies
+            return self._policy_last_modified
+
+    # The remote lists don't change during the run, their digest is computed once
+    def get_remote_digest(self):
+        with self._remote_digest_lock:
+            if self._remote_digest is None:
+                self._remote_digest = lists_digest(self.get_remote_approved_products_ids(
+                    approved_table_name), self.get_remote_rejected_products_ids(rejected_table_name))
+            return self._remote_digest
+
+    # True if neither the remote lists nor the experience's policy changed since its last sync
+    def is_experience_converged(self, experience_id):
+        if self._fingerprints is None:
+            return False
+        fingerprint = self._fingerprints.get(experience_id)
+        if fingerprint is None or fingerprint['RemoteDigest'] != self.get_remote_digest():
+            return False
+        policy_last_modified = self.get_policies_last_modified().get(
+            fingerprint['PolicyId'])
+        return policy_last_modified is not None and policy_last_modified == fingerprint['PolicyLastModified']
+
+    def save_fingerprints(self, experience_ids):
+        if self._fingerprints is None or not len(experience_ids):
+            return
+        remote_digest = self.get_remote_digest()
+        policies_last_modified = self.get_policies_last_modified(refresh=True)
+        for experience_id in experience_ids:
+            policy_id = self._policy_ids[experience_id]
+            if policy_id in policies_last_modified:
+                self._fingerprints.set(
+                    experience_id, remote_digest, policy_id, policies_last_modified[policy_id])
+
+    # Experiences not in sync with the remote lists, which are read once for all of them
+    def get_outdated_experience_ids(self, experience_ids):
+        return [e for e in experience_ids if not self.is_experience_converged(e)]
+
     def is_experience_to_sync(self, experience_id):
-        experience = self.get_experience(experience_id)
-        admin_status = (json.loads(experience['Details'])).get(
-            'AdminStatus', "")
-        status = (json.loads(experience['Details']))['Status']
-        procpolicy = (json.loads(experience['Details']))[
-            'ProcurementPolicies'][0]
+        details = self.get_experience(experience_id)['DetailsDocument']
+        admin_status = details.get('AdminStatus', "")
+        status = details['Status']
+        procpolicy = details['ProcurementPolicies'][0]
 
         if admin_status == "" and status == 'Enabled' and procpolicy != "":
             return True
@@ -137,55 +1675,184 @@ class PMP:
             return False
 
     def get_products_in_experience(self, experience_id):
-        approved_product_ids = []
-        rejected_product_ids = []
-
-        parameters = {'Catalog': 'AWSMarketplace',
-                      'EntityId': self.get_proc_policy(experience_id)}
-        experience_description = self._client.describe_entity(**parameters)
-        details = json.loads(experience_description['Details'])
+        details = self.get_entity(self.get_proc_policy(experience_id))[
+            'DetailsDocument']
 
-        if jmespath.search("Statements[?Effect=='Allow'].Resources[].Ids[]", details) != None:
-            approved_product_ids = jmespath.search(
-                "Statements[?Effect=='Allow'].Resources[].Ids[]", details)
-        if jmespath.search("Statements[?Effect=='Deny'].Resources[].Ids[]", details) != None:
-            rejected_product_ids = jmespath.search(
-                "Statements[?Effect=='Deny'].Resources[].Ids[]", details)
+        approved_product_ids = get_policy_product_ids(details, 'Allow')
+        rejected_product_ids = get_policy_product_ids(details, 'Deny')
 
         logger.info(
             f"{len(approved_product_ids)} approved products and {len(rejected_product_ids)} rejected products found in {experience_id} experience.")
         return (approved_product_ids, rejected_product_ids)
 
-    def sync_experience(self, expereince_id):
+    # Computes the deltas of the experience and queues its change sets
+    def plan_experience_sync(self, expereince_id):
 
         (approved_product_ids, rejected_product_ids) = self.get_products_in_experience(
             expereince_id)
 
-        local_approved_products_ids = set(approved_product_ids)
-        local_rejected_product_ids = set(rejected_product_ids)
-        remote_approved_product_ids = set(
-            self.get_remote_approved_products_ids(approved_table_name))
-        remote_rejected_product_ids = set(
-            self.get_remote_rejected_products_ids(rejected_table_name))
+        remote_approved_product_ids = self.get_remote_approved_products_ids(
+            approved_table_name)
+        remote_rejected_product_ids = self.get_remote_rejected_products_ids(
+            rejected_table_name)
+
+        # All the lists are sorted, only the deltas are materialized
+        with metrics.phase('Diffing'):
+            delta_approved_product_ids = set()
+            delta_rejected_product_ids = set()
+            for change, product_id in diff_sorted_ids(remote_approved_product_ids, approved_product_ids):
+                if change == 'added':
+                    # Products only in the remote experience, that need to be approve
+                    delta_approved_product_ids.add(product_id)
+                else:
+                    # Approved products in the local experience that need to be rejected
+                    delta_rejected_product_ids.add(product_id)
+            for change, product_id in diff_sorted_ids(remote_rejected_product_ids, rejected_product_ids):
+                if change == 'added':
+                    # Rejected products only in the remote experience, that need to be rejected
+                    delta_rejected_product_ids.add(product_id)
+
+        self.queue_experience_changes(
+            expereince_id, delta_approved_product_ids, delta_rejected_product_ids)
+
+    # Queues the changes of a management lists delta without reading the experience or the remote tables
+    def plan_experience_delta(self, experience_id, delta):
+        approved = delta.get('Approved', {})
+        rejected = delta.get('Rejected', {})
+        delta_approved_product_ids = set(approved.get('Added', []))
+        delta_rejected_product_ids = set(approved.get(
+            'Removed', [])) | set(rejected.get('Added', []))
+        logger.info(f"Applying the management lists delta to {experience_id}")
+        self.queue_experience_changes(
+            experience_id, delta_approved_product_ids, delta_rejected_product_ids)
+
+    # Queues the pending changes of the experience saved in the checkpoint, False if there are none
+    def resume_experience_changes(self, experience_id):
+        if self._checkpoint is None:
+            return False
+        pending_changes = self._checkpoint.get_pending_changes(experience_id)
+        if pending_changes is None:
+            return False
+        logger.info(
+            f"Resuming [{sum(len(c[1]) for c in pending_changes)}] pending product changes from the checkpoint")
+        for change_type, product_ids in pending_changes:
+            self._change_sets.submit(experience_id, change_type, product_ids)
+        return True
+
+    def queue_experience_changes(self, experience_id, delta_approved_product_ids, delta_rejected_product_ids):
+        # Allow and Deny changes can share a change set, the Deny wins as it did when it was applied last
+        delta_approved_product_ids = delta_approved_product_ids - delta_rejected_product_ids
 
-        # Products only in the remote experience, that need to be approve
-        delta_approved_product_ids = remote_approved_product_ids - local_approved_products_ids
-        # Approved products in the local experience that need to be rejected
-        delta_rejected_product_ids = local_approved_products_ids - remote_approved_product_ids
-        # Rejected products only in the remote experience, that need to be rejected
-        delta_rejected_product_ids |= remote_rejected_product_ids - local_rejected_product_ids
+        if self._checkpoint is not None:
+            self._checkpoint.save_pending_changes(experience_id, [(change_type, sorted(product_ids)) for change_type, product_ids in [
+                ("AllowProductProcurement", delta_approved_product_ids), ("DenyProductProcurement", delta_rejected_product_ids)] if len(product_ids)])
 
         logger.info(
             f"Adding [{len(delta_approved_product_ids)}] products to approve list")
-        self.add_product_to_experience(
-            expereince_id, list(delta_approved_product_ids))
+        self.queue_products_for_experience(
+            experience_id, list(delta_approved_product_ids))
 
         logger.info(
             f"Adding [{len(delta_rejected_product_ids)}] products to reject list")
-        self.add_product_to_experience(expereince_id, list(
+        self.queue_products_for_experience(experience_id, list(
             delta_rejected_product_ids), to_approve=False)
 
+    def sync_experience(self, experience_id):
+        if not self.resume_experience_changes(experience_id):
+            self.plan_experience_sync(experience_id)
+        errors = self._change_sets.run()
+        if experience_id in errors:
+            raise errors[experience_id]
+
+    # Plans the experiences in a bounded thread pool and applies all their change sets together,
+    # a failing experience doesn't stop the others. Experiences already at the base version of
+    # list_delta only apply the delta, the others are fully reconciled. sync_id identifies the
+    # sync across invocations, for the change set request tokens.
+    def sync_experiences(self, experience_ids, list_version=None, list_delta=None, sync_id=None):
+        # Queues what doesn't need the experience's policy and returns how the experience is synced
+        def choose(experience_id):
+            if self.resume_experience_changes(experience_id):
+                return 'Resumed'
+            if list_delta is not None and self._list_versions is not None and self._list_versions.get(experience_id) == list_delta['BaseVersion']:
+                self.plan_experience_delta(experience_id, list_delta['Delta'])
+                return 'Delta'
+            if self.is_experience_converged(experience_id):
+                logger.info(
+                    f"Experience {experience_id} already in sync, skipping it")
+                return 'Skipped'
+            return 'Full'
+
+        def plan(index, experience_id):
+            logger.info(
+                f"Syncing experience: {experience_id} [{index+1}/{len(experience_ids)}]")
+            self.plan_experience_sync(experience_id)
+
+        self._change_sets.set_sync_id(sync_id)
+        results = {}
+        if self._checkpoint is not None:
+            for experience_id in self._checkpoint.completed & set(experience_ids):
+                results[experience_id] = {
+                    'Status': 'SUCCEEDED', 'Mode': 'Resumed'}
+        pending_experience_ids = [
+            e for e in experience_ids if e not in results]
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = {executor.submit(choose, experience_id): experience_id
+                       for experience_id in pending_experience_ids}
+            for future, experience_id in futures.items():
+                try:
+                    results[experience_id] = {
+                        'Status': 'SUCCEEDED', 'Mode': future.result()}
+                except Exception as e:
+                    logger.exception(f"Error syncing experience {experience_id}")
+                    results[experience_id] = {
+                        'Status': 'FAILED', 'Error': str(e)}
+
+            full_experience_ids = [e for e in pending_experience_ids if results[e].get(
+                'Mode') == 'Full']
+            try:
+                self.prefetch_policies(full_experience_ids)
+            except Exception:
+                # Describing them one by one tells which experience fails
+                logger.exception("Error describing the experiences' policies")
+
+            futures = {executor.submit(plan, i, experience_id): experience_id for i,
+                       experience_id in enumerate(full_experience_ids)}
+            for future, experience_id in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception(f"Error syncing experience {experience_id}")
+                    results[experience_id] = {
+                        'Status': 'FAILED', 'Error': str(e)}
+
+        with metrics.phase('ChangeSets'):
+            errors = self._change_sets.run()
+        for experience_id, error in errors.items():
+            results[experience_id] = {'Status': 'FAILED', 'Error': str(error)}
+
+        self.save_fingerprints([experience_id for experience_id, result in results.items(
+        ) if result['Status'] == 'SUCCEEDED' and result.get('Mode') == 'Full'])
+
+        # The resumed experiences were planned against list_version too, a checkpoint is only
+        # resumed by a sync of the version it was started for
+        if list_version is not None and self._list_versions is not None:
+            for experience_id, result in results.items():
+                if result['Status'] == 'SUCCEEDED':
+                    self._list_versions.set(experience_id, list_version)
+
+        if self._checkpoint is not None and all(r['Status'] == 'SUCCEEDED' for r in results.values()):
+            self._checkpoint.finish()
+        return results
+
     def add_product_to_experience(self, experience_id, pproducts, to_approve=True):
+        self.queue_products_for_experience(
+            experience_id, pproducts, to_approve)
+        errors = self._change_sets.run()
+        if experience_id in errors:
+            raise errors[experience_id]
+
+    def queue_products_for_experience(self, experience_id, pproducts, to_approve=True):
         # if the to_approve parameter is false, the products are added to the rejected products
 
         if not len(pproducts):
@@ -193,139 +1860,41 @@ class PMP:
                         ("approve." if to_approve else "reject."))
             return
 
-        waiter_name = 'AddProductWaiter'
-        delay = 5
-        max_attempts = 60
-        waiter_config = {
-            'version': 2,
-            'waiters': {
-                waiter_name: {
-                    "delay": delay,
-                    "maxAttempts": max_attempts,
-                    "operation": "DescribeChangeSet",
-                    "acceptors": [
-                        {
-                            "matcher": "path",
-                            "expected": "SUCCEEDED",
-                            "argument": "Status",
-                            "state": "success"
-                        },
-                        {
-                            "matcher": "path",
-                            "expected": "PREPARING",
-                            "argument": "Status",
-                            "state": "retry"
-                        },
-                        {
-                            "matcher": "path",
-                            "expected": "APPLYING",
-                            "argument": "Status",
-                            "state": "retry"
-                        },
-                        {
-                            "matcher": "path",
-                            "expected": "CANCELLED",
-                            "argument": "Status",
-                            "state": "failure"
-                        },
-                        {
-                            "matcher": "path",
-                            "expected": "FAILED",
-                            "argument": "Status",
-                            "state": "failure"
-                        }
-                    ]
-                }
-            }
-        }
-        waiter_model = WaiterModel(waiter_config)
-
-        products_slices = self.slice_array(pproducts, self._batch_size)
-        i = 1
+        change_type = "AllowProductProcurement" if to_approve else "DenyProductProcurement"
         logger.info(f"Total products to add: {len(pproducts)}")
-        for p in (products_slices):
-            logger.info(f"Batch [{i}/{len(products_slices)}]")
-            i += 1
-            products = {
-                'Products': [
-                    {
-                        "Ids": p
-                    }
-                ]
-            }
-
-            change_type = "AllowProductProcurement" if to_approve else "DenyProductProcurement"
-
-            kargs = {
-                'Catalog': 'AWSMarketplace',
-                'ChangeSet': [
-                    {
-                        'ChangeType': change_type,
-                        'Entity': {
-                            'Type': 'Experience@1.0',
-                            'Identifier': experience_id
-                        },
-                        'Details': json.dumps(products),
-                    },
-                ],
-                'ClientRequestToken': str(uuid.uuid4())
-            }
-            while True:
-                try:
-                    response = self._client.start_change_set(**kargs)
-
-                    custome_waiter = create_waiter_with_client(
-                        waiter_name, waiter_model, self._client)
-
-                    try:
-                        custome_waiter.wait(
-                            ChangeSetId=response['ChangeSetId'], Catalog='AWSMarketplace')
-                    except WaiterError as e:
-                        logger.error(WaiterError)
-                        logger.error(e)
-                        raise
-
-                    break
-                except Exception as e:
-                    logger.error(e)
-                    wait_time = 30
-                    logger.error(f"Waiting {wait_time} secs")
-                    time.sleep(wait_time)
-                    logger.info(f"Retrying...")
-                    continue
-
-    def slice_array(self, array, size):
-        return [array[i:i + size] for i in range(0, len(array), size)]
+        self._change_sets.submit(experience_id, change_type, pproducts)
 
     # If the SSM parameter MemberExperienceIds has value it will get used to sync, if not all experience in the account will be returned.
     def get_experience_ids(self):
         if len(self._experience_ids):
             return self._experience_ids
 
-        client = boto3.client('ssm')
-        try:
-            self._experience_ids = client.get_parameter(
-                Name=ssm_parameter_prefix + 'MemberExperienceIds')['Parameter']['Value'].split(',')
-
+        self._experience_ids = get_parameter_list('MemberExperienceIds')
+        if len(self._experience_ids):
             return self._experience_ids
-        except client.exceptions.ParameterNotFound:
-            logging.info("MemberExperienceIds wasn't found in Parameter store")
+        logging.info("MemberExperienceIds wasn't found in Parameter store")
 
         parameters = {'Catalog': 'AWSMarketplace', 'EntityType': "Experience", 'FilterList' : [{'Name': 'Scope', 'ValueList': [ 'SharedWithMe'] }] }
-        response = self._client.list_entities(**parameters)
+        response = retry_policy.call(self._client.list_entities, **parameters)
         experience_ids = [e.get('EntityId')
                           for e in response.get('EntitySummaryList')]
 
         while "NextToken" in response:
             parameters["NextToken"] = self._experiences = response.get(
                 'NextToken')
-            response = self._client.list_entities(**parameters)
+            response = retry_policy.call(self._client.list_entities, **parameters)
             experience_ids.extend([e.get('EntityId')
                                   for e in response.get('EntitySummaryList')])
 
         logging.debug (f"Experiences return by CAPI")
         logging.debug (experience_ids)
 
+        try:
+            self.describe_entities(experience_ids)
+        except Exception:
+            logging.info(
+                "Some experiences couldn't be described, checking them one by one")
+
         experiences_to_sync = []
 
         for id in experience_ids:
@@ -335,40 +1904,107 @@ class PMP:
             except:
                 logging.info(
                     f"Experience {id} doesn't have a procurament policy, is not active, or is archived. Experience is being ignored.")
-        self.experience_ids = experiences_to_sync
-        return self.experience_ids
+        self._experience_ids = experiences_to_sync
+        return self._experience_ids
 
     def get_experience(self, experience_id):
-        parameters = {'Catalog': 'AWSMarketplace', 'EntityId': experience_id}
-        experience = self._client.describe_entity(**parameters)
-        return (experience)
+        return self.get_entity(experience_id)
 
     def get_audiences(self):
         parameters = {'Catalog': 'AWSMarketplace', 'EntityType': "Audience"}
-        response = self._client.list_entities(**parameters)
+        response = retry_policy.call(self._client.list_entities, **parameters)
         audiences = [e.get('EntityId')
                      for e in response.get('EntitySummaryList')]
 
         while "NextToken" in response:
             parameters["NextToken"] = self._audiences = response.get(
                 'NextToken')
-            response = self._client.list_entities(**parameters)
+            response = retry_policy.call(self._client.list_entities, **parameters)
             audiences.extend([e.get('EntityId')
                              for e in response.get('EntitySummaryList')])
 
         return audiences
 
+    def get_audience_index(self, refresh=False):
+        global audience_index
+        if audience_index is None:
+            audience_index = AudienceIndex()
+        if refresh or not audience_index.is_fresh():
+            audience_index.build(self)
+        return audience_index
+
     def is_aws_account_id_in_active_experience_audiences(self, account_id):
-        for audience in self.get_audiences():
-            audience_description = self._client.describe_entity(
-                Catalog='AWSMarketplace', EntityId=audience)
-            audience_details = json.loads(audience_description['Details'])
-            if account_id in audience_details.get('Principals', []) and audience_details.get('ExperienceId') in self.get_experience_ids():
-                return True
-        return False
+        experience_ids = self.get_audience_index().get_experiences(account_id)
+        return len(experience_ids & set(self.get_experience_ids())) > 0
+
+    # Active experiences covering each account, for the given accounts or every account in an audience
+    def get_accounts_coverage(self, account_ids=None):
+        active_experience_ids = set(self.get_experience_ids())
+        coverage = self.get_audience_index().get_coverage()
+        if account_ids is None:
+            account_ids = coverage.keys()
+        return {account_id: sorted(coverage.get(account_id, set()) & active_experience_ids) for account_id in account_ids}
 
 
 def lambda_handler(event, context):
+    global startup_timings
+    set_invocation_deadline(context)
+    if startup_timings is not None:
+        if startup_timing:
+            logger.info(
+                f"Module imported in {startup_timings['ImportTime'] * 1000:.0f} ms and initialized in {startup_timings['InitTime'] * 1000:.0f} ms")
+            metrics.record_startup(startup_timings)
+        startup_timings = None
+    try:
+        return run_profiled(context, sync_notifications, parse_notifications(event), context)
+    finally:
+        metrics.flush(context)
+
+
+# Runs one sync for all the notifications of the batch, holding the sync lease when there is a sync
+# state table. If another sync holds it, the notifications are deferred to it and the invocation ends.
+def sync_notifications(messages, context):
+    if not sync_state_table_name:
+        return sync(messages, context)
+    lease = SyncLease(sync_state_table_name, context)
+    pending = lease.acquire()
+    while pending is None:
+        if lease.defer(messages):
+            logger.info(
+                f"Another sync is running, [{len(messages)}] notifications deferred to it")
+            return {'Status': 'DEFERRED'}
+        pending = lease.acquire()
+    if len(pending):
+        logger.info(
+            f"Folding [{len(pending)}] deferred notifications into the sync")
+    return run_syncs(lease, messages + pending, context)
+
+
+# Syncs the notifications holding the lease, then the ones deferred to it meanwhile
+def run_syncs(lease, messages, context):
+    try:
+        while True:
+            results = sync(messages, context, lease)
+            if results.get('Status') == 'FANNED_OUT':
+                # The worker that completes the run releases the lease
+                return results
+            messages = lease.release()
+            if not len(messages):
+                return results
+            if remaining_time() < follow_up_min_time:
+                logger.warning(
+                    f"Not enough time left for a follow-up sync, [{len(messages)}] notifications left to the next sync")
+                lease.abandon(messages)
+                return results
+            logger.info(
+                f"Running a follow-up sync for [{len(messages)}] notifications received during the sync")
+    except Exception:
+        lease.abandon(messages)
+        raise
+
+
+# Loads the names of the management tables, returns the name of the sync timestamps table
+def load_table_names():
     global approved_table_name, rejected_table_name
     approved_table_name = getParameters('ApprovedTable')
     logger.info('ApprovedTable from parameter store is ' + approved_table_name)
@@ -377,19 +2013,132 @@ def lambda_handler(event, context):
     sync_timestamps_table_name = getParameters('SyncTimestampsTableName')
     logger.info('SyncTimestampsTableName from parameter store is ' +
                 sync_timestamps_table_name)
+    return sync_timestamps_table_name
 
-    pmp = PMP()
-    experiences = pmp.get_experience_ids()
+
+def sync(messages, context, lease=None):
+    started_at = time.time()
+    sync_timestamps_table_name = load_table_names()
+
+    list_version, list_delta = get_list_delta(messages)
+    snapshot_ref = get_snapshot_ref(messages)
+    logger.info(
+        f"Management lists version {list_version}, delta {'received' if list_delta else 'not available'}")
+
+    checkpoint = SyncCheckpoint(
+        sync_state_table_name) if sync_state_table_name else None
+    list_versions = ListVersionStore(
+        sync_state_table_name) if sync_state_table_name else None
+    fingerprints = ExperienceFingerprints(
+        sync_state_table_name) if sync_state_table_name else None
+    pmp = PMP(checkpoint=checkpoint, list_versions=list_versions, fingerprints=fingerprints,
+              snapshot={'Ref': snapshot_ref, 'MinVersion': list_version} if snapshot_ref else None)
+    outdated_experiences = None
+    with metrics.phase('Discovery'):
+        if checkpoint is not None and checkpoint.resume(list_version):
+            experiences = checkpoint.experience_ids
+            logger.info(
+                f"Resuming the sync started at {datetime.datetime.fromtimestamp(checkpoint.started_at).isoformat()}, [{len(checkpoint.completed)}] experiences already synced")
+        else:
+            experiences = pmp.get_experience_ids()
+            if lease is not None and work_queue is not None and len(experiences) >= fan_out_min_experiences:
+                outdated_experiences = pmp.get_outdated_experience_ids(
+                    experiences)
+            if checkpoint is not None and (outdated_experiences is None or len(outdated_experiences) < fan_out_min_experiences):
+                checkpoint.start(experiences, list_version)
+
+    if outdated_experiences is not None and len(outdated_experiences) >= fan_out_min_experiences:
+        return fan_out(lease, pmp, outdated_experiences, len(experiences) - len(outdated_experiences),
+                       list_version, list_delta)
 
     number_of_experiences = len(experiences)
     logger.info(f"Syncing [{number_of_experiences}] experiences")
 
-    i = 0
-    for exp_id in experiences:
-        logger.info(f"Syncing experience: {exp_id} [{i+1}/{len(experiences)}]")
-        pmp.sync_experience(exp_id)
-        i += 1
+    try:
+        results = pmp.sync_experiences(experiences, list_version, list_delta,
+                                       sync_id=checkpoint.started_at if checkpoint is not None else None)
+    except DeadlineExceeded as e:
+        logger.error(f"Stopping the sync before the Lambda timeout: {e}")
+        raise
+    failed_experiences = [exp_id for exp_id,
+                          result in results.items() if result['Status'] == 'FAILED']
 
     logger.info(f"Updating timestamp")
     update_sync_timestamp(sync_timestamps_table_name,
-                          context, number_of_experiences)
+                          context, number_of_experiences - len(failed_experiences), list_version, time.time() - started_at)
+
+    if len(failed_experiences):
+        raise RuntimeError(
+            f"[{len(failed_experiences)}/{number_of_experiences}] experiences failed to sync: {failed_experiences}")
+    return results
+
+
+# Sends one work item per experience to the workers. The lists they sync to are stored once with
+# the run, the work items only carry its reference.
+def fan_out(lease, pmp, experience_ids, skipped, list_version, list_delta):
+    run_id = str(uuid.uuid4())
+    with metrics.phase('FanOut'):
+        lease.extend(fan_out_timeout)
+        lists = {'Version': list_version, 'Delta': list_delta,
+                 'Approved': pmp.get_remote_approved_products_ids(approved_table_name),
+                 'Rejected': pmp.get_remote_rejected_products_ids(rejected_table_name)}
+        lists_ref = FanOutRun(sync_state_table_name).start(
+            run_id, experience_ids, skipped, lease.owner, lists)
+        work_queue.send([{'RunId': run_id, 'ExperienceId': experience_id, 'ListsRef': lists_ref}
+                         for experience_id in experience_ids])
+    logger.info(
+        f"Sync {run_id} fanned out to [{len(experience_ids)}] workers, [{skipped}] experiences already in sync")
+    return {'Status': 'FANNED_OUT', 'RunId': run_id, 'Experiences': len(experience_ids)}
+
+
+def worker_handler(event, context):
+    set_invocation_deadline(context)
+    try:
+        return [run_profiled(context, sync_work_item, json.loads(record['body']), context) for record in (event or {}).get('Records', [])]
+    finally:
+        metrics.flush(context)
+
+
+# Syncs the experience of the work item. The worker that completes the run updates the sync
+# timestamp and releases the lease, running the notifications deferred to it meanwhile.
+def sync_work_item(item, context):
+    sync_timestamps_table_name = load_table_names()
+    experience_id = item['ExperienceId']
+    fan_out_run = FanOutRun(sync_state_table_name)
+    lists = fan_out_run.load_lists(item['ListsRef'])
+    list_version = lists['Version']
+    pmp = PMP(list_versions=ListVersionStore(sync_state_table_name), fingerprints=ExperienceFingerprints(sync_state_table_name),
+              remote_lists=(lists['Approved'], lists['Rejected']))
+    result = pmp.sync_experiences(
+        [experience_id], list_version, lists['Delta'], sync_id=item['RunId'])[experience_id]
+    if result['Status'] == 'FAILED':
+        logger.error(
+            f"Experience {experience_id} failed to sync: {result['Error']}")
+
+    run = fan_out_run.complete(
+        item['RunId'], experience_id, result['Status'] == 'SUCCEEDED')
+    if run is None:
+        return result
+    failed_experiences = sorted(run.get('Failed', []))
+    logger.info(
+        f"Sync {item['RunId']} completed, [{len(failed_experiences)}/{run['Experiences']}] experiences failed to sync: {failed_experiences}")
+    logger.info(f"Updating timestamp")
+    update_sync_timestamp(sync_timestamps_table_name, context, len(run.get('Succeeded', [])) + int(run['Skipped']),
+                          list_version, time.time() - float(run['StartedAt']))
+
+    lease = SyncLease(sync_state_table_name, owner=run['LeaseOwner'])
+    messages = lease.release()
+    if len(messages):
+        if remaining_time() < follow_up_min_time:
+            logger.warning(
+                f"Not enough time left for a follow-up sync, [{len(messages)}] notifications left to the next sync")
+            lease.abandon(messages)
+        else:
+            logger.info(
+                f"Running a follow-up sync for [{len(messages)}] notifications received during the sync")
+            run_syncs(lease, messages, context)
+    return result
+
+
+startup_timings['InitTime'] = time.perf_counter() - \
+    startup_started_at - startup_timings['ImportTime']
@@ -0,0 +1,137 @@
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+'''
+Fixtures running the Lambdas against in-process stand-ins of the AWS services, like the benchmarks:
+moto for DynamoDB, S3, SQS, SSM, STS and Organizations, and benchmark/fake_catalog.py for the
+Marketplace Catalog API.
+'''
+
+os.environ.update({'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'testing',
+                   'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_SESSION_TOKEN': 'testing',
+                   'SSM_PREFIX': 'pmp-test', 'SYNC_STATE_TABLE': 'pmp-member-SyncState'})
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'benchmark'))
+from fake_catalog import FakeCatalog  # noqa: E402
+
+
+def create_table(table_name):
+    boto3.client('dynamodb').create_table(TableName=table_name, KeySchema=[{'AttributeName': 'ID', 'KeyType': 'HASH'}],
+                                          AttributeDefinitions=[{'AttributeName': 'ID', 'AttributeType': 'S'}], BillingMode='PAY_PER_REQUEST')
+
+
+def load_lambda(name, component):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(root, component, 'src', 'lambda', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        boto3.setup_default_session()
+        create_table(os.environ['SYNC_STATE_TABLE'])
+        yield
+
+
+# The member Lambda, loaded in the mocked environment so its clients and state are new
+@pytest.fixture
+def member(aws):
+    module = load_lambda('member_app', 'member')
+    module.ChangeSetPipeline.min_poll_interval = 0.01
+    module.ChangeSetPipeline.initial_expected_duration = 0.01
+    return module
+
+
+@pytest.fixture
+def catalog(aws):
+    catalog = FakeCatalog()
+    catalog.register(boto3.DEFAULT_SESSION.events)
+    yield catalog
+    boto3.DEFAULT_SESSION.events.unregister(
+        'before-send.marketplace-catalog', catalog.handle_request)
+
+
+class LambdaContext:
+    def __init__(self, aws_request_id='test'):
+        self.aws_request_id = aws_request_id
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+# A management org with its tables and a member org with experiences in the fake catalog.
+# The lists are changed with change_lists, which returns the notification of the new version.
+class Organization:
+    def __init__(self, catalog, experiences=3, products=10):
+        self.catalog = catalog
+        self.approved = {f"prod-{i:04d}" for i in range(products)}
+        self.rejected = set()
+        self.version = 1
+        self.next_product = products
+        self.experience_ids = [f"exp-{i}" for i in range(experiences)]
+        for table_name in ('ApprovedProducts', 'RejectedProducts', 'SyncTimestamps'):
+            create_table(f"pmp-test-{table_name}")
+        self._write_lists(self.approved, set())
+        boto3.client('organizations').create_organization(FeatureSet='ALL')
+        ssm = boto3.client('ssm')
+        for name, value in {'ApprovedTable': 'pmp-test-ApprovedProducts', 'RejectedTable': 'pmp-test-RejectedProducts',
+                            'SyncTimestampsTableName': 'pmp-test-SyncTimestamps',
+                            'CrossAccountAccessRoleARN': 'arn:aws:iam::123456789012:role/pmp-member-access'}.items():
+            ssm.put_parameter(Name=f"/pmp/{name}", Value=value, Type='String')
+
+    # The experiences start in sync with version 1 of the lists
+    def sync_experiences(self, member):
+        versions = member.ListVersionStore(os.environ['SYNC_STATE_TABLE'])
+        for i, experience_id in enumerate(self.experience_ids):
+            self.catalog.add_experience(
+                experience_id, f"procpolicy-{i}", self.approved, self.rejected)
+            versions.set(experience_id, self.version)
+
+    def _write_lists(self, approved, rejected):
+        for table_name, ids in (('ApprovedProducts', approved), ('RejectedProducts', rejected)):
+            table = boto3.resource('dynamodb').Table(f"pmp-test-{table_name}")
+            for product_id in ids:
+                table.put_item(Item={'ID': product_id})
+
+    def _delete_lists(self, approved):
+        table = boto3.resource('dynamodb').Table('pmp-test-ApprovedProducts')
+        for product_id in approved:
+            table.delete_item(Key={'ID': product_id})
+
+    # Approves added new products and rejects rejected approved ones
+    def change_lists(self, added=4, rejected=2):
+        added_ids = {f"prod-{i:04d}" for i in range(
+            self.next_product, self.next_product + added)}
+        self.next_product += added
+        rejected_ids = set(sorted(self.approved)[:rejected])
+        self.approved = (self.approved - rejected_ids) | added_ids
+        self.rejected |= rejected_ids
+        self._delete_lists(rejected_ids)
+        self._write_lists(added_ids, rejected_ids)
+        self.version += 1
+        return {'Action': 'Products-Updated', 'Version': self.version,
+                'Delta': {'Approved': {'Added': sorted(added_ids), 'Removed': sorted(rejected_ids)},
+                          'Rejected': {'Added': sorted(rejected_ids), 'Removed': []}}}
+
+    def is_converged(self):
+        return all(self.catalog.get_products(e) == (self.approved, self.rejected) for e in self.experience_ids)
+
+
+def sqs_event(*messages):
+    return {'Records': [{'messageId': str(i), 'body': json.dumps(m)} for i, m in enumerate(messages)]}
+
+
+@pytest.fixture
+def organization(member, catalog):
+    return Organization(catalog)
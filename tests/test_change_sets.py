@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+
+def pipeline(member, sync_id=None):
+    client = member.get_client(
+        'marketplace-catalog', region_name='us-east-1', config=member.no_retries)
+    change_sets = member.ChangeSetPipeline(client, 5)
+    change_sets.set_sync_id(sync_id)
+    return change_sets
+
+
+def apply(member, sync_id, change_type, product_ids):
+    change_sets = pipeline(member, sync_id)
+    change_sets.submit('exp-1', change_type, product_ids)
+    assert change_sets.run() == {}
+
+
+def test_same_changes_in_later_syncs_are_applied(member, catalog):
+    catalog.add_experience('exp-1', 'procpolicy-1')
+    apply(member, 'sync-1', 'DenyProductProcurement', ['prod-1'])
+    apply(member, 'sync-2', 'AllowProductProcurement', ['prod-1'])
+    apply(member, 'sync-3', 'DenyProductProcurement', ['prod-1'])
+    assert catalog.get_products('exp-1') == (set(), {'prod-1'})
+
+
+def test_retried_request_returns_the_same_change_set(member, catalog):
+    catalog.add_experience('exp-1', 'procpolicy-1')
+    first = pipeline(member, 'sync-1')
+    first.submit('exp-1', 'DenyProductProcurement', ['prod-1'])
+    first._start_queued()
+    retried = pipeline(member, 'sync-1')
+    retried._checked_experiences.add('exp-1')
+    retried.submit('exp-1', 'DenyProductProcurement', ['prod-1'])
+    retried._start_queued()
+    assert list(first._in_flight) == list(retried._in_flight)
+
+
+def test_change_set_finished_before_the_submission_is_resubmitted(member, catalog):
+    catalog.add_experience('exp-1', 'procpolicy-1')
+    apply(member, 'sync-1', 'DenyProductProcurement', ['prod-1'])
+    apply(member, 'sync-2', 'AllowProductProcurement', ['prod-1'])
+    # sync-1 resumed long after its change set finished
+    for change_set in catalog._change_sets.values():
+        change_set['StartTime'] = '2020-01-01T00:00:00.000000Z'
+    apply(member, 'sync-1', 'DenyProductProcurement', ['prod-1'])
+    assert catalog.get_products('exp-1') == (set(), {'prod-1'})
+
+
+def test_experiences_share_change_sets_with_one_change_of_each_type(member, catalog):
+    approved = [f"prod-{i:04d}" for i in range(300)]
+    rejected = [f"prod-{i:04d}" for i in range(300, 420)]
+    for experience_id in ('exp-1', 'exp-2'):
+        catalog.add_experience(experience_id, f"procpolicy-{experience_id}")
+    change_sets = pipeline(member, 'sync-1')
+    for experience_id in ('exp-1', 'exp-2'):
+        change_sets.submit(experience_id, 'AllowProductProcurement', approved)
+        change_sets.submit(experience_id, 'DenyProductProcurement', rejected)
+    assert change_sets.run() == {}
+    for experience_id in ('exp-1', 'exp-2'):
+        assert catalog.get_products(experience_id) == (
+            set(approved), set(rejected))
+    for change_set in catalog._change_sets.values():
+        changes = [(c['Entity']['Identifier'], c['ChangeType'])
+                   for c in change_set['ChangeSet']]
+        assert len(changes) == len(set(changes))
+    assert any(len(change_set['Experiences']) == 2
+               for change_set in catalog._change_sets.values())
+
+
+def test_change_set_repeating_a_change_on_an_entity_is_rejected(member, catalog):
+    catalog.add_experience('exp-1', 'procpolicy-1')
+    client = pipeline(member)._client
+    change = {'ChangeType': 'DenyProductProcurement', 'Entity': {'Type': 'Experience@1.0', 'Identifier': 'exp-1'},
+              'Details': json.dumps({'Products': [{'Ids': ['prod-1']}]})}
+    with pytest.raises(ClientError) as error:
+        client.start_change_set(
+            Catalog='AWSMarketplace', ChangeSet=[change, change])
+    assert error.value.response['Error']['Code'] == 'ValidationException'
@@ -0,0 +1,13 @@
+from conftest import LambdaContext, sqs_event
+
+
+def test_expired_delta_falls_back_to_a_full_reconciliation(member, organization):
+    organization.sync_experiences(member)
+    notification = organization.change_lists()
+    # The chunks of the delta were never stored, as if they had expired
+    del notification['Delta']
+    notification['DeltaRef'] = {
+        'Table': 'pmp-test-ListVersions', 'Chunks': 2}
+    assert member.get_list_delta([notification]) == (2, None)
+    member.lambda_handler(sqs_event(notification), LambdaContext())
+    assert organization.is_converged()
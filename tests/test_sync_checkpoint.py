@@ -0,0 +1,81 @@
+import boto3
+import pytest
+
+from conftest import LambdaContext, sqs_event
+
+
+# Lets the next syncs start `starts` change sets of one experience, then the invocation runs out of time
+def interrupt_after(monkeypatch, member, starts):
+    started = []
+    can_start = member.ChangeSetPipeline._can_start
+
+    def limited_can_start(self):
+        return len(started) < starts and can_start(self)
+    original_start = member.ChangeSetPipeline._start
+
+    def counted_start(self, changes):
+        started.extend(sorted({c[0] for c in changes}))
+        return original_start(self, changes)
+    # One experience per change set
+    monkeypatch.setattr(member, 'max_changes_per_change_set', 2)
+    monkeypatch.setattr(member.ChangeSetPipeline,
+                        '_can_start', limited_can_start)
+    monkeypatch.setattr(member.ChangeSetPipeline, '_start', counted_start)
+    return started
+
+
+def test_sync_interrupted_by_the_deadline_is_resumed(monkeypatch, member, organization):
+    organization.sync_experiences(member)
+    notification = organization.change_lists()
+    with monkeypatch.context() as patch:
+        started = interrupt_after(patch, member, 1)
+        with pytest.raises(member.DeadlineExceeded):
+            member.lambda_handler(sqs_event(notification), LambdaContext())
+    assert len(started) == 1
+    assert not organization.is_converged()
+
+    checkpoint = member.SyncCheckpoint(member.sync_state_table_name)
+    assert checkpoint.resume(notification['Version'])
+    assert checkpoint.completed == set(started)
+
+    remaining = set(organization.experience_ids) - set(started)
+    started = interrupt_after(monkeypatch, member, 10)
+    member.lambda_handler(sqs_event(notification), LambdaContext())
+    assert set(started) == remaining
+    assert organization.is_converged()
+    assert not member.SyncCheckpoint(
+        member.sync_state_table_name).resume(notification['Version'])
+
+
+def test_checkpoint_of_an_older_version_is_not_resumed(monkeypatch, member, organization):
+    organization.sync_experiences(member)
+    v2 = organization.change_lists()
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, member, 1)
+        with pytest.raises(member.DeadlineExceeded):
+            member.lambda_handler(sqs_event(v2), LambdaContext())
+
+    v3 = organization.change_lists()
+    member.lambda_handler(sqs_event(v2, v3), LambdaContext())
+    assert organization.is_converged()
+    versions = member.ListVersionStore(member.sync_state_table_name)
+    assert all(versions.get(e) == 3 for e in organization.experience_ids)
+
+    v4 = organization.change_lists()
+    member.lambda_handler(sqs_event(v4), LambdaContext())
+    assert organization.is_converged()
+
+
+def test_pending_changes_larger_than_an_item_are_saved_in_chunks(monkeypatch, member):
+    monkeypatch.setattr(member, 'checkpoint_chunk_size', 1000)
+    checkpoint = member.SyncCheckpoint(member.sync_state_table_name)
+    checkpoint.start(['exp-1'], 2)
+    changes = [('AllowProductProcurement', [f"prod-{i:05d}" for i in range(5000)]),
+               ('DenyProductProcurement', [f"prod-{i:05d}" for i in range(5000, 6000)])]
+    checkpoint.save_pending_changes('exp-1', changes)
+    item = boto3.resource('dynamodb').Table(member.sync_state_table_name).get_item(
+        Key={'ID': 'checkpoint#exp-1'})['Item']
+    assert item['Chunks'] > 1
+    assert checkpoint.get_pending_changes('exp-1') == changes
+    checkpoint.save_pending_changes('exp-1', changes[1:])
+    assert checkpoint.get_pending_changes('exp-1') == changes[1:]
@@ -0,0 +1,81 @@
+from conftest import LambdaContext, sqs_event
+
+
+def test_lease_is_held_by_one_owner(member):
+    first = member.SyncLease(member.sync_state_table_name, owner='first')
+    second = member.SyncLease(member.sync_state_table_name, owner='second')
+    assert first.acquire() == []
+    assert second.acquire() is None
+    assert first.release() == []
+    assert second.acquire() == []
+
+
+def test_notifications_deferred_to_the_owner_are_returned_on_release(member):
+    first = member.SyncLease(member.sync_state_table_name, owner='first')
+    second = member.SyncLease(member.sync_state_table_name, owner='second')
+    assert not second.defer([{'Version': 2}])
+    assert first.acquire() == []
+    assert second.defer([{'Version': 2, 'Delta': {}}])
+    assert second.defer([{'Version': 3}])
+    # The lease is kept for the follow-up sync of the deferred notifications
+    assert first.release() == [{'Version': 2}, {'Version': 3}]
+    assert second.acquire() is None
+    assert first.release() == []
+    assert second.acquire() == []
+
+
+def test_abandoned_lease_is_acquired_with_its_notifications(member):
+    first = member.SyncLease(member.sync_state_table_name, owner='first')
+    second = member.SyncLease(member.sync_state_table_name, owner='second')
+    assert first.acquire() == []
+    first.abandon([{'Version': 2}])
+    assert second.acquire() == [{'Version': 2}]
+    # The former owner can't release the lease of the new one
+    assert first.release() == []
+    assert member.SyncLease(member.sync_state_table_name,
+                            owner='third').acquire() is None
+
+
+def test_notifications_received_during_a_sync_are_folded_into_a_follow_up(monkeypatch, member, organization):
+    organization.sync_experiences(member)
+    v2 = organization.change_lists()
+    v3 = organization.change_lists()
+    syncs = []
+    sync = member.sync
+
+    def sync_receiving_v3(messages, context, lease=None):
+        syncs.append(sorted(m['Version'] for m in messages))
+        if len(syncs) == 1:
+            result = member.lambda_handler(
+                sqs_event(v3), LambdaContext('second'))
+            assert result == {'Status': 'DEFERRED'}
+        return sync(messages, context, lease)
+    monkeypatch.setattr(member, 'sync', sync_receiving_v3)
+
+    member.lambda_handler(sqs_event(v2), LambdaContext('first'))
+    assert syncs == [[2], [3]]
+    assert organization.is_converged()
+    assert member.SyncLease(member.sync_state_table_name,
+                            owner='third').acquire() == []
+
+
+def test_notifications_of_an_abandoned_sync_are_folded_into_the_next_one(monkeypatch, member, organization):
+    organization.sync_experiences(member)
+    holder = member.SyncLease(member.sync_state_table_name, owner='holder')
+    assert holder.acquire() == []
+    v2 = organization.change_lists()
+    assert member.lambda_handler(sqs_event(v2), LambdaContext('first')) == {
+        'Status': 'DEFERRED'}
+    holder.abandon()
+
+    syncs = []
+    sync = member.sync
+
+    def recorded_sync(messages, context, lease=None):
+        syncs.append(sorted(m['Version'] for m in messages))
+        return sync(messages, context, lease)
+    monkeypatch.setattr(member, 'sync', recorded_sync)
+    v3 = organization.change_lists()
+    member.lambda_handler(sqs_event(v3), LambdaContext('second'))
+    assert syncs == [[2, 3]]
+    assert organization.is_converged()